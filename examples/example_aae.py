@@ -16,20 +16,16 @@ mpi4py.rc.initialize = False
 from mpi4py import MPI
 
 # molecules stuff
+from molecules.utils import parse_dict
 from molecules.ml.hyperparams import OptimizerHyperparams
 from molecules.ml.callbacks import (LossCallback, CheckpointCallback,
                                     SaveEmbeddingsCallback, TSNEPlotCallback,
                                     LatspaceStatisticsCallback)
 from molecules.ml.unsupervised.point_autoencoder import AAE3d, AAE3dHyperparams
 
-def parse_dict(ctx, param, value):
-    if value is not None:
-        token = value.split(",")
-        result = {}
-        for item in token:
-            k, v = item.split("=")
-            result[k] = v
-        return result
+# checkpoint files are named epoch-<epoch>-<date>-<time>.pt
+_CKPT_RE = re.compile(r"epoch-\d+-(\d+-\d+)\.pt$")
+
 
 
 def get_dataset(dataset_location, input_path, dataset_name, rmsd_name, fnc_name,
@@ -53,7 +49,7 @@ def get_dataset(dataset_location, input_path, dataset_name, rmsd_name, fnc_name,
         # split across nodes
         if num_shards > 1:
             chunksize = len(dataset) // num_shards
-            dataset = Subset(dataset, list(range(chunksize * shard_id, chunksize * (shard_id + 1))))
+            dataset = Subset(dataset, range(chunksize * shard_id, chunksize * (shard_id + 1)))
             
     elif dataset_location == 'cpu-memory':
         from molecules.ml.datasets import PointCloudInMemoryDataset
@@ -213,14 +209,14 @@ def main(input_path, dataset_name, rmsd_name, fnc_name,
         "latent_dim": latent_dim,
         "encoder_kernel_sizes": encoder_kernel_sizes,
         "noise_std": 0.2,
-        "lambda_rec": float(loss_weights["lambda_rec"]),
-        "lambda_gp": float(loss_weights["lambda_gp"])
+        "lambda_rec": loss_weights["lambda_rec"],
+        "lambda_gp": loss_weights["lambda_gp"]
         }
     hparams = AAE3dHyperparams(**aae_hparams)
     
     # optimizers
     optimizer_hparams = OptimizerHyperparams(name = optimizer["name"],
-                                             hparams={'lr':float(optimizer["lr"])})
+                                             hparams={'lr':optimizer["lr"]})
 
     # create a dir for storing the model
     model_path = join(out_path, f'model-{model_id}')
@@ -246,6 +242,11 @@ def main(input_path, dataset_name, rmsd_name, fnc_name,
 
     # set global default device
     torch.cuda.set_device(enc_device.index)
+
+    # constant input shapes: let cuDNN autotune once and use TF32 tensor cores
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     
     if comm_rank == 0:
         # Diplay model 
@@ -322,7 +323,7 @@ def main(input_path, dataset_name, rmsd_name, fnc_name,
     # Optional callbacks
     loss_callback = LossCallback(join(model_path, 'loss.json'),
                                  wandb_config=wandb_config,
-                                 mpi_comm=comm)
+                                 use_dist=(comm_size > 1))
     
     checkpoint_callback = CheckpointCallback(out_dir=join(model_path, 'checkpoint'),
                                              mpi_comm=comm)
@@ -353,8 +354,8 @@ def main(input_path, dataset_name, rmsd_name, fnc_name,
     
     # see if resume is set
     if resume and (checkpoint is None):
-        clist = [x for x in os.listdir(join(model_path, 'checkpoint')) if x.endswith(".pt")]
-        checkpoints = sorted(clist, key=lambda x: re.match("epoch-\d*?-(\d*?-\d*?).pt", x).groups()[0])
+        clist = [x for x in os.listdir(join(model_path, 'checkpoint')) if _CKPT_RE.match(x)]
+        checkpoints = sorted(clist, key=lambda x: _CKPT_RE.match(x).group(1))
         if checkpoints:
             checkpoint = join(model_path, 'checkpoint', checkpoints[-1])
             if comm_rank == 0:
@@ -1,5 +1,4 @@
 import os
-import re
 import click
 import warnings
 from os.path import join
@@ -9,28 +8,17 @@ from torchsummary import summary
 import torch
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, Subset
-
-# mpi4py
-import mpi4py
-mpi4py.rc.initialize = False
-from mpi4py import MPI
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 # molecules stuff
-from molecules.ml.datasets import ContactMapDataset
+from molecules.ml.datasets import ContactMapDataset, materialize_dataset
+from molecules.utils import parse_dict
 from molecules.ml.hyperparams import OptimizerHyperparams
 from molecules.ml.callbacks import (LossCallback, CheckpointCallback,
                                     SaveEmbeddingsCallback, TSNEPlotCallback)
 from molecules.ml.unsupervised.vae import VAE, SymmetricVAEHyperparams, ResnetVAEHyperparams
 
-def parse_dict(ctx, param, value):
-    if value is not None:
-        token = value.split(",")
-        result = {}
-        for item in token:
-            k, v = item.split("=")
-            result[k] = v
-        return result
 
 @click.command()
 @click.option('-i', '--input', 'input_path', required=True,
@@ -74,7 +62,7 @@ def parse_dict(ctx, param, value):
 
 @click.option('-f', '--cm_format', default='sparse-concat',
               help='Format of contact map files. Options ' \
-                   '[full, sparse-concat, sparse-rowcol]')
+                   '[full, sparse-concat, sparse-rowcol, packed]')
 
 @click.option('-E', '--encoder_gpu', default=None, type=int,
               help='Encoder GPU id')
@@ -125,16 +113,39 @@ def parse_dict(ctx, param, value):
 @click.option('-a', '--amp', is_flag=True,
               help='Specify if we want to enable automatic mixed precision (AMP)')
 
+@click.option('--amp_dtype', default='fp16', type=click.Choice(['fp16', 'bf16']),
+              help='Precision used by AMP. bf16 skips loss scaling')
+
+@click.option('--fused_adam/--no-fused_adam', default=True,
+              help='Use the fused (or multi-tensor) Adam/AdamW implementation')
+
+@click.option('--accum_steps', default=1, type=int,
+              help='Number of batches to accumulate gradients over per optimizer step')
+
+@click.option('--max_grad_norm', default=None, type=float,
+              help='Clip gradients to this total norm before each optimizer step')
+
+@click.option('--compile', 'enable_compile', is_flag=True,
+              help='Compile the model with torch.compile')
+
+@click.option('--log_interval', default=100, type=int,
+              help='Print the training loss every log_interval batches')
+
 @click.option('--distributed', is_flag=True,
               help='Enable distributed training')
 
-@click.option('-ndw', '--num_data_workers', default=0, type=int, 
-              help='Number of data loaders for training')
+@click.option('--max_in_memory_gb', default=0., type=float,
+              help='Datasets whose dense contact maps are smaller than this are ' \
+                   'decoded once and kept in memory. Disabled by default')
+
+@click.option('-ndw', '--num_data_workers', default=None, type=int,
+              help='Number of data loaders for training. Defaults to ' \
+                   'min(8, cpu_count // world_size)')
 
 def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, resume, model_prefix,
          dim1, dim2, init_weights, cm_format, encoder_gpu, decoder_gpu, epochs, batch_size, optimizer, loss_weights, model_type,
          latent_dim, encoder_resnet_layers, scale_factor, embed_interval, tsne_interval, sample_interval, 
-         wandb_project_name, local_rank, amp, distributed, num_data_workers):
+         wandb_project_name, local_rank, amp, amp_dtype, fused_adam, accum_steps, max_grad_norm, enable_compile, log_interval, distributed, max_in_memory_gb, num_data_workers):
 
     """Example for training Fs-peptide with either Symmetric or Resnet VAE."""
     
@@ -149,15 +160,30 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
     comm = None
     if distributed and dist.is_available():
 
-        # init mpi4py:
-        MPI.Init_thread()
+        # torchrun sets RANK, WORLD_SIZE and LOCAL_RANK, only use mpi4py
+        # when launched through mpirun/jsrun
+        if os.getenv("USE_MPI", "0") == "1":
+            import mpi4py
+            mpi4py.rc.initialize = False
+            from mpi4py import MPI
+
+            # init mpi4py:
+            MPI.Init_thread()
+
+            # get communicator: duplicate from comm world
+            comm = MPI.COMM_WORLD.Dup()
+
+            # now match ranks between the mpi comm and the nccl comm
+            os.environ["WORLD_SIZE"] = str(comm.Get_size())
+            os.environ["RANK"] = str(comm.Get_rank())
 
-        # get communicator: duplicate from comm world
-        comm = MPI.COMM_WORLD.Dup()
+        if local_rank is not None:
+            comm_local_rank = local_rank
+        else:
+            comm_local_rank = int(os.getenv("LOCAL_RANK", 0))
 
-        # now match ranks between the mpi comm and the nccl comm
-        os.environ["WORLD_SIZE"] = str(comm.Get_size())
-        os.environ["RANK"] = str(comm.Get_rank())
+        # the device has to be set before nccl is initialized
+        torch.cuda.set_device(comm_local_rank)
 
         # init torch distributed
         dist.init_process_group(backend='nccl',
@@ -165,14 +191,15 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
         comm_rank = dist.get_rank()
         comm_size = dist.get_world_size()
 
-        if local_rank is not None:
-            comm_local_rank = local_rank
-        else:
-            comm_local_rank = int(os.getenv("LOCAL_RANK", 0))
-            
         if comm_rank == 0:
             print("Distributed setup complete")
 
+        # each rank trains on its local GPU unless told otherwise
+        if encoder_gpu is None:
+            encoder_gpu = comm_local_rank
+        if decoder_gpu is None:
+            decoder_gpu = encoder_gpu
+
     assert model_type in ['symmetric', 'resnet']
 
     # Note: See SymmetricVAEHyperparams, ResnetVAEHyperparams class definitions
@@ -198,13 +225,14 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
                           'dec_filters': dim1,
                           'enc_reslayers': encoder_resnet_layers,
                           'scale_factor': scale_factor,
-                          'lambda_rec': float(loss_weights["lambda_rec"]),
+                          'lambda_rec': loss_weights["lambda_rec"],
                           'output_activation': 'None'}
 
-        input_shape = (dim1, dim1)
+        input_shape = (dim1, dim2)
         hparams = ResnetVAEHyperparams(**resnet_hparams)
 
-    optimizer_hparams = OptimizerHyperparams(name=optimizer["name"], hparams={'lr': float(optimizer["lr"])})
+    optimizer_hparams = OptimizerHyperparams(name=optimizer["name"], hparams={'lr': optimizer["lr"]},
+                                             fused=fused_adam)
 
     # For ease of training multiple models
     model_path = join(out_path, f'model-{model_prefix}')
@@ -215,23 +243,33 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
         hparams.save(join(model_path, 'model-hparams.json'))
         optimizer_hparams.save(join(model_path, 'optimizer-hparams.json'))
 
+    # set global default device before the model and DDP are created
+    if encoder_gpu is not None:
+        torch.cuda.set_device(encoder_gpu)
+
+    # constant input shapes: let cuDNN autotune once and use TF32 tensor cores
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # create model
     vae = VAE(input_shape, hparams, optimizer_hparams,
               gpu=(encoder_gpu, decoder_gpu),
               enable_amp=amp,
-              init_weights=init_weights)
+              amp_dtype=amp_dtype,
+              accum_steps=accum_steps,
+              max_grad_norm=max_grad_norm,
+              channels_last=(model_type == 'symmetric'),
+              enable_compile=enable_compile,
+              init_weights=init_weights,
+              log_interval=log_interval)
 
-    enc_device = torch.device(f'cuda:{encoder_gpu}')
-    dec_device = torch.device(f'cuda:{decoder_gpu}')
     if comm_size > 1:
         if (encoder_gpu == decoder_gpu):
-            vae.model = DDP(vae.model, device_ids = [enc_device], output_device = enc_device)
+            vae.model = DDP(vae.model, device_ids = [encoder_gpu], output_device = encoder_gpu)
         else:
             vae.model = DDP(vae.model, device_ids = None, output_device = None)
 
-    # set global default device
-    torch.cuda.set_device(enc_device.index)
-
     # Diplay model
     if comm_rank == 0:
         print(vae)
@@ -247,19 +285,36 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
                                       input_shape,
                                       split='train',
                                       cm_format=cm_format)
+    if max_in_memory_gb > 0:
+        train_dataset = materialize_dataset(train_dataset,
+                                            max_bytes = int(max_in_memory_gb * 2**30))
 
     # split across nodes
+    train_sampler = None
     if comm_size > 1:
-        chunksize = len(train_dataset) // comm_size
-        train_dataset = Subset(train_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
-    
+        train_sampler = DistributedSampler(train_dataset,
+                                           num_replicas = comm_size,
+                                           rank = comm_rank,
+                                           shuffle = True,
+                                           drop_last = True)
+
+    # data loader workers: overlap HDF5 decoding with the training step
+    if num_data_workers is None:
+        num_data_workers = min(8, (os.cpu_count() or 1) // comm_size)
+    loader_kwargs = {'pin_memory': True,
+                     'num_workers': num_data_workers}
+    if num_data_workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
+    if encoder_gpu is not None:
+        loader_kwargs['pin_memory_device'] = f'cuda:{encoder_gpu}'
+
     train_loader = DataLoader(train_dataset,
                               batch_size = batch_size,
                               drop_last = True,
-                              shuffle = True,
-                              pin_memory = True,
-                              num_workers = num_data_workers)
+                              shuffle = (train_sampler is None),
+                              sampler = train_sampler,
+                              **loader_kwargs)
 
     # validation
     valid_dataset = ContactMapDataset(input_path,
@@ -269,22 +324,28 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
                                       input_shape,
                                       split='valid',
                                       cm_format=cm_format)
+    if max_in_memory_gb > 0:
+        valid_dataset = materialize_dataset(valid_dataset,
+                                            max_bytes = int(max_in_memory_gb * 2**30))
 
     # split across nodes
+    valid_sampler = None
     if comm_size > 1:
-        chunksize = len(valid_dataset) // comm_size
-        valid_dataset = Subset(valid_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
-    
+        valid_sampler = DistributedSampler(valid_dataset,
+                                           num_replicas = comm_size,
+                                           rank = comm_rank,
+                                           shuffle = True,
+                                           drop_last = True)
+
     valid_loader = DataLoader(valid_dataset,
                               batch_size = batch_size,
                               drop_last = True,
-                              shuffle = True,
-                              pin_memory = True,
-                              num_workers = num_data_workers)
+                              shuffle = (valid_sampler is None),
+                              sampler = valid_sampler,
+                              **loader_kwargs)
 
     ## we call next once here to make sure the data is pinned to the right GPU
-    #with torch.cuda.device(enc_device.index):
+    #with torch.cuda.device(encoder_gpu):
     #    _ = next(train_loader)
     #    _ = valid_loader.next()
 
@@ -322,7 +383,7 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
     # Optional callbacks
     loss_callback = LossCallback(join(model_path, 'loss.json'),
                                  wandb_config=wandb_config,
-                                 mpi_comm=comm)
+                                 use_dist=(comm_size > 1))
     
     checkpoint_callback = CheckpointCallback(out_dir=join(model_path, 'checkpoint'),
                                              mpi_comm=comm)
@@ -346,10 +407,10 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
 
     # see if resume is set
     if resume and (checkpoint is None):
-        clist = [x for x in os.listdir(join(model_path, 'checkpoint')) if x.endswith(".pt")]
-        checkpoints = sorted(clist, key=lambda x: re.match("epoch-\d*?-(\d*?-\d*?).pt", x).groups()[0])
-        if checkpoints:
-            checkpoint = join(model_path, 'checkpoint', checkpoints[-1])
+        # pick the most recently written checkpoint
+        entries = [e for e in os.scandir(join(model_path, 'checkpoint')) if e.name.endswith(".pt")]
+        if entries:
+            checkpoint = max(entries, key=lambda e: e.stat().st_mtime).path
             if comm_rank == 0:
                 print(f"Resuming from checkpoint {checkpoint}.")
         else:
@@ -359,7 +420,8 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path, checkpoint, re
     
     # create model
     vae.train(train_loader, valid_loader, epochs,
-              checkpoint=checkpoint, callbacks=callbacks)
+              checkpoint=checkpoint, callbacks=callbacks,
+              sampler=train_sampler)
 
     if comm_rank == 0:
         # Save loss history to disk.
@@ -8,18 +8,16 @@ from torchsummary import summary
 import torch
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, Subset
-
-# mpi4py
-import mpi4py
-mpi4py.rc.initialize = False
-from mpi4py import MPI
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
 # molecules stuff
 from molecules.ml.datasets import PointCloudDataset
+from molecules.utils import parse_dict
 from molecules.ml.hyperparams import OptimizerHyperparams
 from molecules.ml.callbacks import (LossCallback, CheckpointCallback,
                                     SaveEmbeddingsCallback, TSNEPlotCallback)
+from molecules.ml.callbacks.callback import Callback
 from molecules.ml.unsupervised.point_autoencoder import AAE3d, AAE3dHyperparams
 
 # hpo stuff
@@ -27,18 +25,17 @@ import ray
 from ray import tune
 from hyperopt import hp
 from ray.tune.suggest.hyperopt import HyperOptSearch
+from ray.tune.schedulers import ASHAScheduler
 from ray.tune.integration.wandb import wandb_mixin
 from ray.tune.integration.wandb import WandbLogger
 
-# parser
-def parse_dict(ctx, param, value):
-    if value is not None:
-        token = value.split(",")
-        result = {}
-        for item in token:
-            k, v = item.split("=")
-            result[k] = v
-        return result
+# report the validation loss after every epoch so that
+# the scheduler can stop unpromising trials early
+class TuneReportCallback(Callback):
+    def on_validation_end(self, epoch, logs):
+        if self.is_eval_node:
+            tune.report(loss_eg = logs['valid_loss'])
+
 
 @click.command()
 @click.option('-i', '--input', 'input_path', required=True,
@@ -94,12 +91,37 @@ def parse_dict(ctx, param, value):
 @click.option('--distributed', is_flag=True,
               help='Enable distributed training')
 
+@click.option('-a', '--amp', is_flag=True,
+              help='Specify if we want to enable automatic mixed precision (AMP)')
+
+@click.option('--amp_dtype', default='fp16', type=click.Choice(['fp16', 'bf16']),
+              help='Precision used by AMP. bf16 skips loss scaling')
+
+@click.option('--fused_adam/--no-fused_adam', default=True,
+              help='Use the fused (or multi-tensor) Adam/AdamW implementation')
+
+@click.option('--accum_steps', default=1, type=int,
+              help='Number of batches to accumulate gradients over per optimizer step')
+
+@click.option('--cuda_graph', is_flag=True,
+              help='Capture the training step in a CUDA graph (single GPU, no fp16 loss scaling)')
+
+@click.option('--num_samples', default=20, type=int,
+              help='Number of HPO trials')
+
+@click.option('--max_concurrent', default=1, type=int,
+              help='Maximum number of trials running at the same time')
+
+@click.option('--gpus_per_trial', default=1., type=float,
+              help='Fraction of a GPU assigned to each trial, e.g. 0.5 runs two trials per GPU')
+
 def main(input_path, dataset_name, rmsd_name,
          out_path, model_prefix,
          num_points, num_features,
          encoder_gpu, generator_gpu, discriminator_gpu,
          epochs, loss_weights, sample_interval, local_rank,
-         wandb_api_key, wandb_project_name, distributed):
+         wandb_api_key, wandb_project_name, distributed, amp, amp_dtype, fused_adam, accum_steps, cuda_graph,
+         num_samples, max_concurrent, gpus_per_trial):
          """Example for training Fs-peptide with AAE3d."""
          
          # init raytune
@@ -124,7 +146,7 @@ def main(input_path, dataset_name, rmsd_name,
                  "lr": hp.loguniform("lr", 1e-5, 1e-1)
              },
              "latent_dim": hp.choice("latent_dim", [64, 128, 256]),
-             "loss_weights": {key: float(loss_weights[key]) for key in loss_weights},
+             "loss_weights": loss_weights,
              "encoder_kernel_sizes": hp.choice("encoder_kernel_sizes", 
                  [[3, 3, 1, 1, 1], 
                  [5, 3, 3, 1, 1],
@@ -134,6 +156,11 @@ def main(input_path, dataset_name, rmsd_name,
              "sample_interval": sample_interval,
              "distributed": distributed,
              "local_rank": local_rank,
+             "amp": amp,
+             "amp_dtype": amp_dtype,
+             "fused_adam": fused_adam,
+             "accum_steps": accum_steps,
+             "cuda_graph": cuda_graph,
              "wandb": {
                  "project": wandb_project_name,
                  "api_key": wandb_api_key
@@ -149,13 +176,21 @@ def main(input_path, dataset_name, rmsd_name,
          tune_config_good["noise_std"] = 0
          
          hyperopt_search = HyperOptSearch(tune_config, points_to_evaluate = [tune_config_good],
-             max_concurrent=1, metric="loss_eg", mode="min")
+             max_concurrent=max_concurrent, metric="loss_eg", mode="min")
+
+         # stop bad trials after a few epochs instead of running all of them to the end
+         asha_scheduler = ASHAScheduler(time_attr='training_iteration',
+                                        metric="loss_eg", mode="min",
+                                        max_t=epochs,
+                                        grace_period=max(1, epochs // 10),
+                                        reduction_factor=3)
 
          analysis = tune.run(run_config, 
                          loggers=[WandbLogger], 
-                         resources_per_trial={'gpu': 1}, 
-                         num_samples=20, 
-                         search_alg=hyperopt_search)
+                         resources_per_trial={'gpu': gpus_per_trial}, 
+                         num_samples=num_samples, 
+                         search_alg=hyperopt_search,
+                         scheduler=asha_scheduler)
          
          # goodbye
          ray.shutdown()
@@ -189,6 +224,11 @@ def run_config(config):
     local_rank = config["local_rank"]
     encoder_kernel_sizes = config["encoder_kernel_sizes"]
     noise_std = config["noise_std"]
+    amp = config["amp"]
+    amp_dtype = config["amp_dtype"]
+    fused_adam = config["fused_adam"]
+    accum_steps = config["accum_steps"]
+    cuda_graph = config["cuda_graph"]
     
     # use this as unique identifier
     model_id = time.strftime(f"{model_prefix}-%Y%m%d-%H%M%S")
@@ -199,25 +239,53 @@ def run_config(config):
     comm_local_rank = 0
     comm = None
     if distributed and dist.is_available():
-        # init mpi4py:
-        MPI.Init_thread()
+        # torchrun sets RANK, WORLD_SIZE and LOCAL_RANK, only use mpi4py
+        # when launched through mpirun/jsrun
+        if os.getenv("USE_MPI", "0") == "1":
+            import mpi4py
+            mpi4py.rc.initialize = False
+            from mpi4py import MPI
+
+            # init mpi4py:
+            MPI.Init_thread()
+
+            # get communicator: duplicate from comm world
+            comm = MPI.COMM_WORLD.Dup()
+
+            # now match ranks between the mpi comm and the nccl comm
+            os.environ["WORLD_SIZE"] = str(comm.Get_size())
+            os.environ["RANK"] = str(comm.Get_rank())
 
-        # get communicator: duplicate from comm world
-        comm = MPI.COMM_WORLD.Dup()
+        if local_rank is not None:
+            comm_local_rank = local_rank
+        else:
+            comm_local_rank = int(os.getenv("LOCAL_RANK", 0))
 
-        # now match ranks between the mpi comm and the nccl comm
-        os.environ["WORLD_SIZE"] = str(comm.Get_size())
-        os.environ["RANK"] = str(comm.Get_rank())
+        # the device has to be set before nccl is initialized
+        torch.cuda.set_device(comm_local_rank)
 
         # init pytorch
         dist.init_process_group(backend='nccl',
                                 init_method='env://')
         comm_rank = dist.get_rank()
         comm_size = dist.get_world_size()
-        if local_rank is not None:
-            comm_local_rank = local_rank
-        else:
-            comm_local_rank = int(os.getenv("LOCAL_RANK", 0))
+
+        # each rank trains on its local GPU unless told otherwise
+        if encoder_gpu is None:
+            encoder_gpu = comm_local_rank
+        if generator_gpu is None:
+            generator_gpu = encoder_gpu
+        if discriminator_gpu is None:
+            discriminator_gpu = encoder_gpu
+
+    # set global default device before the model and DDP are created
+    if encoder_gpu is not None:
+        torch.cuda.set_device(encoder_gpu)
+
+    # constant input shapes: let cuDNN autotune once and use TF32 tensor cores
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     
     # HP
     # model
@@ -226,22 +294,26 @@ def run_config(config):
         "latent_dim": latent_dim,
         "encoder_kernel_sizes": encoder_kernel_sizes,
         "noise_std": noise_std,
-        "lambda_rec": float(loss_weights["lambda_rec"]),
-        "lambda_gp": float(loss_weights["lambda_gp"])
+        "lambda_rec": loss_weights["lambda_rec"],
+        "lambda_gp": loss_weights["lambda_gp"]
         }
     hparams = AAE3dHyperparams(**aae_hparams)
     
     # optimizers
     optimizer_hparams = OptimizerHyperparams(name = optimizer["name"],
-                                             hparams={'lr':float(optimizer["lr"])})
+                                             hparams={'lr':optimizer["lr"]},
+                                             fused = fused_adam)
 
     aae = AAE3d(num_points, num_features, batch_size, hparams, optimizer_hparams,
-              gpu=(encoder_gpu, generator_gpu, discriminator_gpu))
+              gpu=(encoder_gpu, generator_gpu, discriminator_gpu),
+              enable_amp=amp,
+              amp_dtype=amp_dtype,
+              accum_steps=accum_steps,
+              cuda_graph=cuda_graph)
 
     if comm_size > 1:
-        if (encoder_gpu == decoder_gpu):
-            devid = torch.device(f'cuda:{encoder_gpu}')
-            aae.model = DDP(aae.model, device_ids = [devid], output_device = devid)
+        if (encoder_gpu == generator_gpu == discriminator_gpu):
+            aae.model = DDP(aae.model, device_ids = [encoder_gpu], output_device = encoder_gpu)
         else:
             aae.model = DDP(aae.model, device_ids = None, output_device = None)
     
@@ -263,13 +335,27 @@ def run_config(config):
                                       cms_transform = False)
 
     # split across nodes
+    train_sampler = None
     if comm_size > 1:
-        chunksize = len(train_dataset) // comm_size
-        train_dataset = Subset(train_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
-    
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle = True, drop_last = True,
-                              pin_memory = True, num_workers = 1)
+        train_sampler = DistributedSampler(train_dataset,
+                                           num_replicas = comm_size,
+                                           rank = comm_rank,
+                                           shuffle = True,
+                                           drop_last = True)
+
+    # data loader workers: overlap HDF5 decoding with the training step
+    num_data_workers = min(8, (os.cpu_count() or 1) // comm_size)
+    loader_kwargs = {'pin_memory': True,
+                     'num_workers': num_data_workers}
+    if num_data_workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 4
+    if encoder_gpu is not None:
+        loader_kwargs['pin_memory_device'] = f'cuda:{encoder_gpu}'
+
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle = (train_sampler is None),
+                              sampler = train_sampler, drop_last = True,
+                              **loader_kwargs)
 
     valid_dataset = PointCloudDataset(input_path,
                                       dataset_name,
@@ -281,13 +367,17 @@ def run_config(config):
                                       cms_transform = False)
 
     # split across nodes
+    valid_sampler = None
     if comm_size > 1:
-        chunksize = len(valid_dataset) // comm_size
-        valid_dataset = Subset(valid_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
-    
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle = True, drop_last = True,
-                              pin_memory = True, num_workers = 1)
+        valid_sampler = DistributedSampler(valid_dataset,
+                                           num_replicas = comm_size,
+                                           rank = comm_rank,
+                                           shuffle = True,
+                                           drop_last = True)
+
+    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle = (valid_sampler is None),
+                              sampler = valid_sampler, drop_last = True,
+                              **loader_kwargs)
 
     print(f"Having {len(train_dataset)} training and {len(valid_dataset)} validation samples.")
     
@@ -313,7 +403,7 @@ def run_config(config):
     # Optional callbacks
     loss_callback = LossCallback(join(model_path, 'loss.json'),
                                  wandb_config=wandb_config,
-                                 mpi_comm=comm)
+                                 use_dist=(comm_size > 1))
     
     checkpoint_callback = CheckpointCallback(out_dir=join(model_path, 'checkpoint'),
                                              mpi_comm=comm)
@@ -333,13 +423,15 @@ def run_config(config):
                                      mpi_comm=comm)
 
     # Train model with callbacks
-    callbacks = [loss_callback, checkpoint_callback, save_callback, tsne_callback]
+    callbacks = [loss_callback, checkpoint_callback, save_callback, tsne_callback,
+                 TuneReportCallback()]
 
 
     # train model with callbacks
     aae.train(train_loader, valid_loader, epochs,
               checkpoint = checkpoint,
-              callbacks = callbacks)
+              callbacks = callbacks,
+              sampler = train_sampler)
 
     # Save loss history to disk.
     if comm_rank == 0:
@@ -354,10 +446,10 @@ def run_config(config):
                          join(model_path, 'generator-weights.pt'),
                          join(model_path, 'discriminator-weights.pt'))
 
-    # prepare return dict
-    final_losses = {key: loss_callback.valid_losses[key][-1] for key in loss_callback.valid_losses}
-
-    return final_losses
+    # report the final losses, the function API takes either reports or a return value
+    if comm_rank == 0:
+        final_losses = {key: loss_callback.valid_losses[key][-1] for key in loss_callback.valid_losses}
+        tune.report(loss_eg = final_losses['valid_loss'], done = True, **final_losses)
 
     # Output directory structure
     #  out_path
@@ -17,6 +17,7 @@ from mpi4py import MPI
 
 # molecules stuff
 from molecules.ml.datasets import ContactMapDataset
+from molecules.utils import parse_dict
 from molecules.ml.hyperparams import OptimizerHyperparams
 from molecules.ml.callbacks import (LossCallback, CheckpointCallback,
                                     SaveEmbeddingsCallback, TSNEPlotCallback)
@@ -30,14 +31,9 @@ from ray.tune.suggest.hyperopt import HyperOptSearch
 from ray.tune.integration.wandb import wandb_mixin
 from ray.tune.integration.wandb import WandbLogger
 
-def parse_dict(ctx, param, value):
-    if value is not None:
-        token = value.split(",")
-        result = {}
-        for item in token:
-            k, v = item.split("=")
-            result[k] = v
-        return result
+# checkpoint files are named epoch-<epoch>-<date>-<time>.pt
+_CKPT_RE = re.compile(r"epoch-\d+-(\d+-\d+)\.pt$")
+
 
 @click.command()
 @click.option('-i', '--input', 'input_path', required=True,
@@ -76,7 +72,7 @@ def parse_dict(ctx, param, value):
 
 @click.option('-f', '--cm_format', default='sparse-concat',
               help='Format of contact map files. Options ' \
-                   '[full, sparse-concat, sparse-rowcol]')
+                   '[full, sparse-concat, sparse-rowcol, packed]')
 
 @click.option('-E', '--encoder_gpu', default=None, type=int,
               help='Encoder GPU id')
@@ -152,7 +148,7 @@ def main(input_path, dataset_name, rmsd_name, fnc_name, out_path,  model_prefix,
         },
         'latent_dim': hp.choice('latent_dim', [64, 128, 256]),
         'scale_factor': hp.choice('scale_factor', [2, 4]),
-        'loss_weights': {key: float(val) for key, val in loss_weights.items()},
+        'loss_weights': loss_weights,
         'model_type': model_type,
         'embed_interval': embed_interval,
         'tsne_interval': tsne_interval,
@@ -275,10 +271,10 @@ def run_config(config):
                           'lambda_rec': loss_weights['lambda_rec'],
                           'output_activation': 'None'}
 
-        input_shape = (dim1, dim1)
+        input_shape = (dim1, dim2)
         hparams = ResnetVAEHyperparams(**resnet_hparams)
 
-    optimizer_hparams = OptimizerHyperparams(name=optimizer['name'], hparams={'lr': float(optimizer["lr"])})
+    optimizer_hparams = OptimizerHyperparams(name=optimizer['name'], hparams={'lr': optimizer["lr"]})
 
     vae = VAE(input_shape, hparams, optimizer_hparams,
               gpu=(encoder_gpu, decoder_gpu), enable_amp=amp)
@@ -294,6 +290,11 @@ def run_config(config):
     # set global default device
     torch.cuda.set_device(enc_device.index)
 
+    # constant input shapes: let cuDNN autotune once and use TF32 tensor cores
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     # Diplay model
     if comm_rank == 0:
         print(vae)
@@ -314,7 +315,7 @@ def run_config(config):
     if comm_size > 1:
         chunksize = len(train_dataset) // comm_size
         train_dataset = Subset(train_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
+                               range(chunksize * comm_rank, chunksize * (comm_rank + 1)))
     
     train_loader = DataLoader(train_dataset,
                               batch_size = batch_size,
@@ -336,7 +337,7 @@ def run_config(config):
     if comm_size > 1:
         chunksize = len(valid_dataset) // comm_size
         valid_dataset = Subset(valid_dataset,
-                               list(range(chunksize * comm_rank, chunksize * (comm_rank + 1))))
+                               range(chunksize * comm_rank, chunksize * (comm_rank + 1)))
     
     valid_loader = DataLoader(valid_dataset,
                               batch_size = batch_size,
@@ -372,7 +373,7 @@ def run_config(config):
     # Optional callbacks
     loss_callback = LossCallback(join(model_path, 'loss.json'),
                                  wandb_config=wandb_config,
-                                 mpi_comm=comm)
+                                 use_dist=(comm_size > 1))
     
     checkpoint_callback = CheckpointCallback(out_dir=join(model_path, 'checkpoint'),
                                              mpi_comm=comm)
@@ -396,8 +397,8 @@ def run_config(config):
 
     # see if resume is set
     if resume and (checkpoint is None):
-        clist = [x for x in os.listdir(join(model_path, 'checkpoint')) if x.endswith(".pt")]
-        checkpoints = sorted(clist, key=lambda x: re.match("epoch-\d*?-(\d*?-\d*?).pt", x).groups()[0])
+        clist = [x for x in os.listdir(join(model_path, 'checkpoint')) if _CKPT_RE.match(x)]
+        checkpoints = sorted(clist, key=lambda x: _CKPT_RE.match(x).group(1))
         if checkpoints:
             checkpoint = join(model_path, 'checkpoint', checkpoints[-1])
             if comm_rank == 0:
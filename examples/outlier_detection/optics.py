@@ -257,10 +257,10 @@ def generate_embeddings(model_type, hparams_path, checkpoint_path, dim1, dim2,
         comm_rank = comm.Get_rank()
 
     if model_type == 'vae-resnet':
-        from molecules.ml.datasets import ContactMapDataset
+        from molecules.ml.datasets import ContactMapDataset, to_model_input
         from molecules.ml.unsupervised.vae.resnet import ResnetVAEHyperparams, ResnetEncoder
         # Initialize encoder model
-        input_shape = (dim1, dim1)
+        input_shape = (dim1, dim2)
         hparams = ResnetVAEHyperparams().load(hparams_path)
         encoder = ResnetEncoder(input_shape, hparams, checkpoint_path)
 
@@ -320,7 +320,10 @@ def generate_embeddings(model_type, hparams_path, checkpoint_path, dim1, dim2,
         print("Generating embeddings")
     embeddings, indices = [], []
     for i, (data, rmsd, fnc, index) in enumerate(data_loader):
-        data = data.to(device)
+        data = data.to(device, non_blocking=True)
+        if model_type == 'vae-resnet':
+            # binary maps come as torch.bool, cast them on the device
+            data = to_model_input(data, input_shape)
         embeddings.append(encoder.encode(data).cpu().numpy())
         indices.append(index)
         if (i % 100 == 0) and (comm_rank == 0):
@@ -100,7 +100,9 @@ def concatenate_h5(
     fout.close()
 
 
-def parse_h5(path: PathLike, fields: List[str]) -> Dict[str, np.ndarray]:
+def parse_h5(
+    path: PathLike, fields: List[str], dtype: Optional[np.dtype] = None
+) -> Dict[str, np.ndarray]:
     r"""Helper function for accessing data fields in H5 file.
 
     Parameters
@@ -109,6 +111,9 @@ def parse_h5(path: PathLike, fields: List[str]) -> Dict[str, np.ndarray]:
         Path to HDF5 file.
     fields : List[str]
         List of dataset field names inside of the HDF5 file.
+    dtype : Optional[np.dtype]
+        If given, each field is converted to `dtype` by HDF5 while it is
+        read into one preallocated contiguous array, without a second copy.
 
     Returns
     -------
@@ -119,5 +124,11 @@ def parse_h5(path: PathLike, fields: List[str]) -> Dict[str, np.ndarray]:
     data = {}
     with h5py.File(path, "r") as f:
         for field in fields:
-            data[field] = f[field][...]
+            dset = f[field]
+            if dtype is None:
+                data[field] = dset[...]
+                continue
+            data[field] = np.empty(dset.shape, dtype=dtype)
+            if dset.size:
+                dset.read_direct(data[field])
     return data
@@ -1,3 +1,5 @@
+import torch.distributed as dist
+
 class Callback:
     def __init__(self, interval=1, mpi_comm=None):
         """
@@ -6,6 +8,8 @@ class Callback:
         interval : int
             Plots every interval epochs, default is once per epoch.
         mpi_com : mpi communicator optional
+            If None and torch.distributed is initialized, the torch
+            rank is used to select the evaluation node.
         """
         if interval < 1:
             raise ValueError('Plot interval must be int greater than 0')
@@ -15,6 +19,8 @@ class Callback:
         self.is_eval_node = True
         if (self.comm is not None) and (self.comm.Get_rank() != 0):
             self.is_eval_node = False
+        elif (self.comm is None) and dist.is_initialized() and (dist.get_rank() != 0):
+            self.is_eval_node = False
 
     def on_train_begin(self, logs): pass
     def on_train_end(self, logs): pass
@@ -1,6 +1,7 @@
 import json
 import wandb
-import numpy as np
+import torch
+import torch.distributed as dist
 from .callback import Callback
 
 class LossCallback(Callback):
@@ -8,7 +9,7 @@ class LossCallback(Callback):
     def __init__(self, path,
                  interval=1,
                  wandb_config=None,
-                 mpi_comm=None):
+                 use_dist=False):
         """
         Parameters
         ----------
@@ -17,13 +18,31 @@ class LossCallback(Callback):
         interval : int
             Plots every interval epochs, default is once per epoch.
         wandb_config : wandb configuration file
-        mpi_comm : mpi communicator for distributed training
+        use_dist : bool
+            If True, average the losses over all ranks with
+            torch.distributed before logging them.
         """
-        super().__init__(interval, mpi_comm)
+        super().__init__(interval)
 
         self.path = path
         self.wandb_config = wandb_config
+        self.use_dist = use_dist
         
+    def _reduce(self, lossnames, logs):
+        # average all losses over the ranks with a single all_reduce
+        if not (self.use_dist and lossnames and dist.is_initialized()):
+            return
+        if dist.get_backend() == 'nccl':
+            device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            device = torch.device('cpu')
+        losses = torch.tensor([logs[x] for x in lossnames],
+                              dtype = torch.float32, device = device)
+        dist.all_reduce(losses, op = dist.ReduceOp.SUM)
+        losses /= float(dist.get_world_size())
+        for lossname, loss in zip(lossnames, losses.tolist()):
+            logs[lossname] = loss
+
     def on_train_begin(self, logs):
         self.epochs = []
         self.train_losses = {}
@@ -39,14 +58,10 @@ class LossCallback(Callback):
         self.epochs.append(epoch)
     
         # train_losses
-        for lossname in [x for x in logs if x.startswith("train_loss")]:
-
-            # reduce losses
-            if self.comm is not None:
-                lossarr = np.array(logs[lossname], dtype = np.float32)
-                logs[lossname] = np.asscalar(self.comm.allreduce(lossarr))
-                logs[lossname] /= float(self.comm.Get_size())
-            
+        lossnames = [x for x in logs if x.startswith("train_loss")]
+        self._reduce(lossnames, logs)
+        for lossname in lossnames:
+
             # manual logging
             if lossname in self.train_losses:
                 self.train_losses[lossname].append(logs[lossname])
@@ -59,14 +74,10 @@ class LossCallback(Callback):
                     
 
         # validation losses
-        for lossname in [x for x in logs if x.startswith("valid_loss")]:
+        lossnames = [x for x in logs if x.startswith("valid_loss")]
+        self._reduce(lossnames, logs)
+        for lossname in lossnames:
 
-            # reduce losses
-            if self.comm is not None:
-                lossarr = np.array(logs[lossname], dtype = np.float32)
-                logs[lossname] = np.asscalar(self.comm.allreduce(lossarr))
-                logs[lossname] /= float(self.comm.Get_size())
-                
             # manual logging
             if lossname in self.valid_losses:
                 self.valid_losses[lossname].append(logs[lossname])
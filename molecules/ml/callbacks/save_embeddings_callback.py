@@ -1,6 +1,8 @@
 import os
 import time
 import numpy as np
+import torch
+import torch.distributed as dist
 from .callback import Callback
 from molecules.utils import open_h5
 
@@ -33,6 +35,11 @@ class SaveEmbeddingsCallback(Callback):
         self.out_dir = out_dir
         self.sample_interval = sample_interval
 
+        # without mpi the samples are gathered with torch.distributed,
+        # same fallback as is_eval_node
+        self.distributed = (self.comm is None) and dist.is_initialized() \
+                           and (dist.get_world_size() > 1)
+
 
     def on_validation_begin(self, epoch, logs):
         self.sample_counter = 0
@@ -50,13 +57,13 @@ class SaveEmbeddingsCallback(Callback):
         if (mu is None) or (rmsd is None) or (fnc is None):
             return
         
-        # decide what to store
-        for idx in range(len(mu)):
-            if (self.sample_counter + idx) % self.sample_interval == 0:
-                # use a singleton slice to keep dimensions intact
-                self.embeddings.append(mu[idx:idx+1].detach().cpu().numpy())
-                self.rmsd.append(rmsd[idx:idx+1].detach().cpu().numpy())
-                self.fnc.append(fnc[idx:idx+1].detach().cpu().numpy())
+        # store every sample_interval'th sample, counted across batches
+        start = -self.sample_counter % self.sample_interval
+        # keep them where they are, they are copied to the host once in on_validation_end
+        if start < len(mu):
+            self.embeddings.append(mu[start::self.sample_interval].detach())
+            self.rmsd.append(rmsd[start::self.sample_interval].detach())
+            self.fnc.append(fnc[start::self.sample_interval].detach())
 
         # increase sample counter
         self.sample_counter += len(mu)
@@ -65,37 +72,38 @@ class SaveEmbeddingsCallback(Callback):
     def on_validation_end(self, epoch, logs):
         if epoch % self.interval != 0:
             return
-        # if the sample interval was too large, we should warn here and return
-        if not self.embeddings or not self.rmsd or not self.fnc:
-            print('Warning, not enough samples collected for tSNE, \
-                  try to reduce sampling interval')
-            return
 
-        # prepare plot data
-        embeddings = np.concatenate(self.embeddings, axis=0).astype(np.float32)
-        rmsd = np.concatenate(self.rmsd, axis=0).astype(np.float32)
-        fnc = np.concatenate(self.fnc, axis=0).astype(np.float32)
+        # prepare plot data, a rank may not have collected any samples
+        # but still has to take part in the gather
+        local = None
+        if self.embeddings:
+            local = tuple(torch.cat(x).float().cpu().numpy()
+                          for x in (self.embeddings, self.rmsd, self.fnc))
 
         # communicate if necessary
+        gathered = [local]
         if self.comm is not None:
-            # gather data
-            embeddings_gather = self.comm.gather(embeddings, root=0)
-            rmsd_gather = self.comm.gather(rmsd, root=0)
-            fnc_gather = self.comm.gather(fnc, root=0)
+            gathered = self.comm.gather(local, root=0)
+        elif self.distributed:
+            gathered = [None] * dist.get_world_size() if self.is_eval_node else None
+            dist.gather_object(local, gathered, dst=0)
 
-            # concat
-            if self.is_eval_node:
-                embeddings = np.concatenate(embeddings_gather, axis=0)
-                rmsd = np.concatenate(rmsd_gather, axis=0)
-                fnc = np.concatenate(fnc_gather, axis=0)
-
-        # Save embeddings to disk
-        if self.is_eval_node and (self.sample_interval > 0):
-            self.save_embeddings(epoch, embeddings, rmsd, fnc, logs)
+        if self.is_eval_node:
+            gathered = [x for x in gathered if x is not None]
+            # if the sample interval was too large, we should warn here
+            if not gathered:
+                print('Warning, not enough samples collected for tSNE, \
+                      try to reduce sampling interval')
+            elif self.sample_interval > 0:
+                # Save embeddings to disk
+                embeddings, rmsd, fnc = (np.concatenate(x, axis=0) for x in zip(*gathered))
+                self.save_embeddings(epoch, embeddings, rmsd, fnc, logs)
 
         # All other nodes wait for node 0 to save
         if self.comm is not None:
             self.comm.barrier()
+        elif self.distributed:
+            dist.barrier()
 
 
     def save_embeddings(self, epoch, embeddings, rmsd, fnc, logs):
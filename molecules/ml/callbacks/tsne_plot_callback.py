@@ -1,5 +1,5 @@
 import os
-from typing import List
+from typing import List, Optional
 from .callback import Callback
 from molecules.plot import plot_tsne
 import concurrent.futures as cf
@@ -22,6 +22,10 @@ class TSNEPlotCallback(Callback):
         pca: bool = True,
         pca_dim: int = 50,
         plot_backend: str = "mpl",
+        tsne_backend: str = "auto",
+        dpi: int = 150,
+        cache_dir: Optional[str] = None,
+        warm_start: bool = False,
         wandb_config=None,
         mpi_comm=None,
     ):
@@ -34,6 +38,15 @@ class TSNEPlotCallback(Callback):
             Plots every interval epochs, default is once per epoch.
         plot_backend: str
             Specify plotting backend as `mpl` for matplotlib or `plotly` for plotly.
+        tsne_backend: str
+            Specify t-SNE backend as `sklearn`, `opentsne`, `tsnecuda`, `cuml` or
+            `auto` to use the fastest installed backend.
+        dpi: int
+            Resolution of the saved plots.
+        cache_dir: str
+            Directory to keep the t-SNE results in, off by default.
+        warm_start: bool
+            Start each t-SNE from the one of the previous plot, requires cache_dir.
         wandb_config : wandb configuration file
         mpi_comm: mpi communicator
         """
@@ -52,6 +65,10 @@ class TSNEPlotCallback(Callback):
                 "pca": pca,
                 "pca_dim": pca_dim,
                 "plot_backend": plot_backend,
+                "tsne_backend": tsne_backend,
+                "dpi": dpi,
+                "cache_dir": cache_dir,
+                "warm_start": warm_start,
             }
 
             self.tnse_is_blocking = tsne_is_blocking
@@ -1,3 +1,4 @@
 from .contact_map import ContactMapDataset
 from .point_cloud import PointCloudDataset
-from .point_cloud_inmemory import PointCloudInMemoryDataset
\ No newline at end of file
+from .point_cloud_inmemory import PointCloudInMemoryDataset
+from .utils import materialize_dataset, unpack_bits, to_model_input
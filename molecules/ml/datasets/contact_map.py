@@ -1,3 +1,4 @@
+import os
 import torch
 import numpy as np
 from torch.utils.data import Dataset
@@ -7,10 +8,14 @@ class ContactMapDataset(Dataset):
     """
     PyTorch Dataset class to load contact matrix data. Uses HDF5
     files and only reads into memory what is necessary for one batch.
+    Binary contact maps are returned as torch.bool on the CPU to reduce
+    host to device traffic. Use a DataLoader with pin_memory=True, copy
+    the batch with non_blocking=True and cast it to float on the device.
+    Batches requested through __getitems__ read each HDF5 chunk once.
     """
     def __init__(self, path, dataset_name, rmsd_name, fnc_name,
                  shape, split_ptc=0.8, split='train', seed=333,
-                 cm_format='sparse-concat'):
+                 cm_format='sparse-concat', chunk_cache_size=None):
         """
         Parameters
         ----------
@@ -40,19 +45,28 @@ class ContactMapDataset(Dataset):
             If 'sparse-concat', process data as concatenated row,col indicies.
             If 'sparse-rowcol', process data as sparse row/col COO format.
             If 'full', process data is normal torch tensors (matrices).
+            If 'packed', process data as binary matrices packed along the
+            last axis with np.packbits (see scripts/pack_contact_maps.py),
+            they are returned as torch.uint8 and have to be unpacked with
+            molecules.ml.datasets.unpack_bits, ideally on the GPU.
             If none of the above, raise a ValueError.
 
         seed : int
             Seed for the RNG for the splitting. Make sure it is the same for all workers reading
             from the same file.  
+
+        chunk_cache_size : int, None
+            Size in bytes of the HDF5 chunk cache of each process reading the file.
+            Every dataloader worker opens the file with its own cache. If None,
+            the cache holds 16 chunks of the contact map dataset, at least 1 MiB.
         """
         if split not in ('train', 'valid'):
             raise ValueError("Parameter split must be 'train' or 'valid'.")
         if split_ptc < 0 or split_ptc > 1:
             raise ValueError('Parameter split_ptc must satisfy 0 <= split_ptc <= 1.')
-        if cm_format not in ('sparse-concat', 'sparse-rowcol', 'full'):
+        if cm_format not in ('sparse-concat', 'sparse-rowcol', 'full', 'packed'):
             raise ValueError(f'Invalid cm_format {cm_format}. Should be one of ' \
-                            '[sparse-rowcol, sparse-concat, full].')
+                            '[sparse-rowcol, sparse-concat, full, packed].')
 
         # HDF5 data params
         self.file_path = path
@@ -61,6 +75,7 @@ class ContactMapDataset(Dataset):
         self.fnc_name = fnc_name
         self.cm_format = cm_format
         self.shape = shape
+        self.chunk_cache_size = chunk_cache_size
         self.load_values = False
         
         # get lengths and paths
@@ -69,13 +84,36 @@ class ContactMapDataset(Dataset):
                 self.len = len(f[self.dataset_name]['row'])
             elif self.cm_format == 'sparse-concat':
                 self.len = len(f[self.dataset_name])
-            elif self.cm_format == 'full':
+            elif self.cm_format in ('full', 'packed'):
                 self.len = len(f[self.dataset_name])
 
             # check if we need to load values
             if self.dataset_name + "_values" in f:
                 self.load_values = True
+
+            # size the chunk cache from the chunk shape
+            dset = f[self.dataset_name]
+            if self.cm_format == 'sparse-rowcol':
+                dset = dset['row']
+            chunk_bytes = 0
+            if dset.chunks is not None:
+                chunk_bytes = int(np.prod(dset.chunks)) * dset.dtype.itemsize
+            if self.chunk_cache_size is None:
+                self.chunk_cache_size = max(1 << 20, 16 * chunk_bytes)
+            # HDF5 recommends 100 hash slots per cached chunk
+            self.chunk_cache_slots = 521
+            if chunk_bytes:
+                self.chunk_cache_slots = max(521, 100 * (self.chunk_cache_size // chunk_bytes))
     
+        # binary maps are stored as torch.bool, packed ones as bytes,
+        # everything else as float
+        self.binary = (self.cm_format != 'full') and not self.load_values
+        self.dtype = torch.bool if self.binary else torch.float32
+        self.data_shape = tuple(self.shape[-2:])
+        if self.cm_format == 'packed':
+            self.dtype = torch.uint8
+            self.data_shape = (self.shape[-2], (self.shape[-1] + 7) // 8)
+
         # do splitting
         self.split_ind = int(split_ptc * self.len)
         self.split = split
@@ -91,7 +129,125 @@ class ContactMapDataset(Dataset):
 
         
     def _init_file(self):
-        self.h5_file = open_h5(self.file_path, 'r', libver = 'latest', swmr = False)
+        # Only happens once per process. Need to open h5 file in current process
+        self.pid = os.getpid()
+        self.h5_file = open_h5(self.file_path, 'r', libver = 'latest', swmr = False,
+                               rdcc_nbytes = self.chunk_cache_size,
+                               rdcc_nslots = self.chunk_cache_slots)
+        if self.cm_format == 'sparse-rowcol':
+            self.row_dset = self.h5_file[self.dataset_name]['row']
+            self.col_dset = self.h5_file[self.dataset_name]['col']
+            if self.load_values:
+                self.val_dset = self.h5_file[self.dataset_name + "_values"]
+        elif self.cm_format == 'sparse-concat':
+            self.dset = self.h5_file[self.dataset_name]
+            if self.load_values:
+                self.val_dset = self.h5_file[self.dataset_name + "_values"]
+        else:
+            self.dset = self.h5_file[self.dataset_name]
+        # Load scalar dsets
+        self.rmsd_dset = self.h5_file[self.rmsd_name]
+        self.fnc_dset = self.h5_file[self.fnc_name]
+        self.initialized = True
+
+
+    @staticmethod
+    def _read_rows(dset, indices):
+        """
+        Reads the rows at indices from dset. Rows in the same HDF5 chunk
+        are read with a single slab read, rows of a contiguous dataset
+        with a single sorted selection.
+
+        Returns
+        -------
+        dict mapping index to row.
+        """
+        unique = np.unique(indices)
+        if dset.chunks is None:
+            return dict(zip(unique, dset[unique]))
+
+        rows = {}
+        chunk_ids = unique // dset.chunks[0]
+        for chunk_id in np.unique(chunk_ids):
+            chunk_indices = unique[chunk_ids == chunk_id]
+            start = chunk_indices[0]
+            slab = dset[start:chunk_indices[-1] + 1]
+            for index in chunk_indices:
+                rows[index] = slab[index - start]
+        return rows
+
+
+    def _read_block(self, indices, out):
+        """
+        Reads the contact maps at indices into the zero initialized dense
+        tensor out. Dense maps are read directly into out, sparse indices
+        are scattered directly into out.
+
+        Returns
+        -------
+        rmsd and fnc dicts mapping index to value.
+        """
+        rmsds = self._read_rows(self.rmsd_dset, indices)
+        fncs = self._read_rows(self.fnc_dset, indices)
+
+        if self.cm_format in ('full', 'packed'):
+            self._read_dense(indices, out.numpy())
+            return rmsds, fncs
+
+        if self.cm_format == 'sparse-rowcol':
+            rows = self._read_rows(self.row_dset, indices)
+            cols = self._read_rows(self.col_dset, indices)
+        else:
+            rows = self._read_rows(self.dset, indices)
+        if not self.binary:
+            vals = self._read_rows(self.val_dset, indices)
+
+        for i, index in enumerate(indices):
+            if self.cm_format == 'sparse-concat':
+                row, col = torch.from_numpy(rows[index].astype(np.int64)).view(2, -1)
+            else: # sparse-rowcol
+                row = torch.from_numpy(rows[index].astype(np.int64))
+                col = torch.from_numpy(cols[index].astype(np.int64))
+            out[i, row, col] = True if self.binary else torch.from_numpy(vals[index]).to(torch.float32)
+
+        return rmsds, fncs
+
+
+    def _read_dense(self, indices, buf):
+        """
+        Reads the dense maps at indices into buf. The sorted indices are
+        split into runs of consecutive rows, or for a chunked dataset into
+        one run per HDF5 chunk. A run of consecutive rows which land in
+        consecutive rows of buf is read directly into buf, any other run
+        with one slab read which is then scattered into buf.
+        """
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind='stable')
+        sorted_indices = indices[order]
+        if self.dset.chunks is None:
+            breaks = np.diff(sorted_indices) != 1
+        else:
+            breaks = np.diff(sorted_indices // self.dset.chunks[0]) != 0
+
+        for run in np.split(np.arange(len(indices)), np.flatnonzero(breaks) + 1):
+            start, stop = sorted_indices[run[0]], sorted_indices[run[-1]] + 1
+            dest = order[run]
+            if (stop - start == len(run)) and np.all(np.diff(dest) == 1):
+                self.dset.read_direct(buf, source_sel=np.s_[start:stop],
+                                      dest_sel=np.s_[dest[0]:dest[-1] + 1])
+            else:
+                buf[dest] = self.dset[start:stop][sorted_indices[run] - start]
+
+
+    def __getstate__(self):
+        # h5 handles are not picklable and not fork safe, every
+        # dataloader worker opens its own
+        state = self.__dict__.copy()
+        for key in ('h5_file', 'dset', 'row_dset', 'col_dset', 'val_dset',
+                    'rmsd_dset', 'fnc_dset'):
+            state.pop(key, None)
+        state['initialized'] = False
+        return state
 
 
     def __len__(self):
@@ -99,53 +255,22 @@ class ContactMapDataset(Dataset):
 
     
     def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
 
-        # Only happens once. Need to open h5 file in current process
-        if not self.initialized:
+    def __getitems__(self, idxs):
+        # a forked worker must not reuse the handle of its parent
+        if not self.initialized or self.pid != os.getpid():
             self._init_file()
-            if self.cm_format == 'sparse-rowcol':
-                self.row_dset = self.h5_file[self.dataset_name]['row']
-                self.col_dset = self.h5_file[self.dataset_name]['col']
-                if self.load_values:
-                    self.val_dset = self.h5_file[self.dataset_name + "_values"]
-            elif self.cm_format == 'sparse-concat':
-                self.dset = self.h5_file[self.dataset_name]
-                if self.load_values:
-                    self.val_dset = self.h5_file[self.dataset_name + "_values"]
-            else:
-                self.dset = self.h5_file[self.dataset_name]
-            # Load scalar dsets
-            self.rmsd_dset = self.h5_file[self.rmsd_name]
-            self.fnc_dset = self.h5_file[self.fnc_name]
-            self.initialized = True
-
-        # get real index
-        index = self.indices[idx]
-        
-        # Select data format and return data at idx
-        if self.cm_format == 'full':
-            data = torch.Tensor(self.dset[index, ...])
-        else:
-            if self.cm_format == 'sparse-concat':
-                ind = self.dset[index, ...].reshape(2, -1)
-                indices = torch.from_numpy(ind).to(torch.long)
-            else: # sparse-rowcol
-                rowind = self.row_dset[index, ...]
-                colind = self.col_dset[index, ...]
-                indices = torch.from_numpy(np.vstack((rowind, colind))).to(torch.long)
 
-            # Create array of 1s, all values in the contact map are 1
-            if self.load_values:
-                values = torch.from_numpy(self.val_dset[index, ...]).to(torch.float32)
-            else:
-                values = torch.ones(indices.shape[1], dtype=torch.float32)
-            # Set shape to the last 2 elements of self.shape.
-            # Handles (1, W, H) and (W, H)
-            data = torch.sparse.FloatTensor(indices, values,
-                                            self.shape[-2:]).to_dense()
-        
-        # these are not dependent on the data format
-        rmsd = torch.tensor(self.rmsd_dset[index], requires_grad=False)
-        fnc = torch.tensor(self.fnc_dset[index], requires_grad=False)
+        # get real indices
+        indices = [self.indices[idx] for idx in idxs]
+
+        # read the batch chunk by chunk into one dense buffer
+        data = torch.zeros((len(indices), *self.data_shape), dtype=self.dtype)
+        rmsds, fncs = self._read_block(indices, data)
 
-        return data, rmsd, fnc, index
+        return [(data[i],
+                 torch.tensor(rmsds[index], requires_grad=False),
+                 torch.tensor(fncs[index], requires_grad=False),
+                 index) for i, index in enumerate(indices)]
@@ -0,0 +1,163 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import TensorDataset
+
+
+def materialize_dataset(dataset, max_bytes=2**32, dtype=None, src=0, block_size=4096,
+                        broadcast_bytes=2**26):
+    """
+    Decodes every sample of a dataset once and keeps the result in memory.
+    Works with datasets returning (data, rmsd, fnc, index) tokens, such as
+    ContactMapDataset and PointCloudDataset. Datasets implementing
+    __getitems__ are read block_size samples at a time through it.
+
+    Parameters
+    ----------
+    dataset : torch.utils.data.Dataset
+        Dataset to materialize.
+
+    max_bytes : int
+        Only materialize if the dense data tensor is smaller than this,
+        otherwise the dataset is returned unchanged.
+
+    dtype : torch.dtype, None
+        Storage type of the data tensor. If None, the type of the samples
+        is kept, e.g. torch.bool for binary and torch.float32 for
+        non-binary contact maps.
+
+    src : int
+        If torch.distributed is initialized, only rank src reads the
+        dataset and broadcasts the tensors to all other ranks.
+
+    block_size : int
+        Number of samples requested at a time.
+
+    broadcast_bytes : int
+        Size of the buffer the tensors are broadcast through, which
+        lives on the GPU for the nccl backend.
+
+    Returns
+    -------
+    torch.utils.data.TensorDataset or the input dataset
+    """
+    distributed = dist.is_initialized() and (dist.get_world_size() > 1)
+    is_src = (not distributed) or (dist.get_rank() == src)
+
+    # only src decodes a sample, the others get its shape and type
+    meta = [None]
+    if is_src:
+        sample = dataset[0][0]
+        meta = [(tuple(sample.shape), sample.dtype)]
+    if distributed:
+        dist.broadcast_object_list(meta, src=src)
+    shape, sample_dtype = meta[0]
+
+    num_samples = len(dataset)
+    if dtype is None:
+        dtype = sample_dtype
+    itemsize = torch.tensor([], dtype=dtype).element_size()
+    if num_samples * int(np.prod(shape)) * itemsize > max_bytes:
+        return dataset
+
+    data = torch.empty((num_samples, *shape), dtype=dtype)
+    rmsd = torch.empty(num_samples, dtype=torch.float32)
+    fnc = torch.empty(num_samples, dtype=torch.float32)
+    index = torch.empty(num_samples, dtype=torch.long)
+
+    if is_src:
+        for start in range(0, num_samples, block_size):
+            stop = min(start + block_size, num_samples)
+            if hasattr(dataset, '__getitems__'):
+                tokens = dataset.__getitems__(range(start, stop))
+            else:
+                tokens = [dataset[idx] for idx in range(start, stop)]
+            batch_data, batch_rmsd, batch_fnc, batch_index = zip(*tokens)
+            data[start:stop] = torch.stack(batch_data)
+            rmsd[start:stop] = torch.tensor([float(x) for x in batch_rmsd])
+            fnc[start:stop] = torch.tensor([float(x) for x in batch_fnc])
+            index[start:stop] = torch.tensor([int(x) for x in batch_index])
+
+    if distributed:
+        _broadcast_blocks((data, rmsd, fnc, index), src, broadcast_bytes)
+
+    return TensorDataset(data, rmsd, fnc, index)
+
+
+def _broadcast_blocks(tensors, src, block_bytes):
+    """
+    Broadcasts the bytes of the contiguous CPU tensors from rank src
+    through one reused buffer of block_bytes.
+    """
+    # nccl can only broadcast device tensors
+    if dist.get_backend() == "nccl":
+        device = torch.device("cuda", torch.cuda.current_device())
+    else:
+        device = torch.device("cpu")
+    is_src = dist.get_rank() == src
+
+    buff = torch.empty(block_bytes, dtype=torch.uint8, device=device)
+    for tensor in tensors:
+        flat = tensor.view(-1).view(torch.uint8)
+        for start in range(0, flat.numel(), block_bytes):
+            block = flat[start:start + block_bytes]
+            view = buff[:block.numel()]
+            if is_src:
+                view.copy_(block)
+            dist.broadcast(view, src=src)
+            if not is_src:
+                block.copy_(view)
+
+
+def unpack_bits(bits, width):
+    """
+    Unpacks binary contact maps which were packed along the last axis
+    with np.packbits. Runs on the device of bits, so that only the
+    packed bytes have to be copied to the GPU.
+
+    Parameters
+    ----------
+    bits : torch.Tensor
+        torch.uint8 tensor of shape (..., ceil(width / 8)).
+
+    width : int
+        Size of the last axis of the unpacked contact maps.
+
+    Returns
+    -------
+    torch.Tensor of type torch.bool and shape (..., width)
+    """
+    mask = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=bits.device)
+    data = torch.bitwise_and(bits.unsqueeze(-1), mask).ne(0)
+    return data.flatten(-2)[..., :width]
+
+
+def to_model_input(data, input_shape, dtype=torch.float32):
+    """
+    Converts a batch of contact maps as returned by ContactMapDataset
+    into the dense floating point input of the VAE encoders. Runs on the
+    device of data, so call it after copying the batch to the GPU.
+
+    Parameters
+    ----------
+    data : torch.Tensor
+        Batch of torch.bool, torch.uint8 (bit packed) or float contact
+        maps of shape (N, H, W) or (N, H, ceil(W / 8)).
+
+    input_shape : tuple
+        Input shape of the model, (1, H, W) or (H, W). A channel
+        dimension is added to the batch if the model expects one.
+
+    dtype : torch.dtype
+        Type of the returned tensor.
+
+    Returns
+    -------
+    torch.Tensor of type dtype and shape (N, *input_shape)
+    """
+    if data.dtype == torch.uint8 and data.shape[-1] != input_shape[-1]:
+        data = unpack_bits(data, input_shape[-1])
+    # the datasets return (H, W) maps, conv2d models expect (1, H, W)
+    if data.dim() == len(input_shape):
+        data = data.unsqueeze(1)
+    return data.to(dtype)
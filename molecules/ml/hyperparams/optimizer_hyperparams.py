@@ -1,8 +1,10 @@
+import inspect
+import torch
 from molecules.ml.hyperparams import Hyperparams
 from torch import optim
 
 class OptimizerHyperparams(Hyperparams):
-    def __init__(self, name='RMSprop', hparams={}):
+    def __init__(self, name='RMSprop', hparams={}, fused=True):
         """
         Parameters
         ----------
@@ -13,9 +15,15 @@ class OptimizerHyperparams(Hyperparams):
             Dictionary of parameters to be passed to optimizer.
             If none are passed, uses default.
 
+        fused : bool
+            If True, Adam and AdamW use the fused CUDA implementation
+            when all parameters are on the GPU, or the multi-tensor
+            (foreach) one otherwise, if the PyTorch version supports it.
+
         """
         self.name = name
         self.hparams = hparams
+        self.fused = fused
 
         super().__init__()
 
@@ -29,6 +37,23 @@ class OptimizerHyperparams(Hyperparams):
     # TODO: could be useful to define bounds for each type of hparams
     #       to assist in the bayesian optization.
 
+def _fused_hparams(optimizer, parameters, hparams):
+    """
+    Adds fused=True or foreach=True to the optimizer arguments
+    if requested and supported by the installed PyTorch.
+    """
+    kwargs = dict(hparams.hparams)
+    if not getattr(hparams, 'fused', False) or ('fused' in kwargs) or ('foreach' in kwargs):
+        return kwargs
+
+    signature = inspect.signature(optimizer).parameters
+    if ('fused' in signature) and torch.cuda.is_available() and \
+        all(p.is_cuda for p in parameters):
+        kwargs['fused'] = True
+    elif 'foreach' in signature:
+        kwargs['foreach'] = True
+    return kwargs
+
 def get_optimizer(parameters, hparams):
     """
     Parameters
@@ -41,6 +66,9 @@ def get_optimizer(parameters, hparams):
 
     """
 
+    # may be a generator and is needed twice for the fused optimizers
+    parameters = list(parameters)
+
     try:
 
         if hparams.name == 'Adadelta':
@@ -50,10 +78,10 @@ def get_optimizer(parameters, hparams):
             return optim.Adagrad(parameters, **hparams.hparams)
 
         elif hparams.name == 'Adam':
-            return optim.Adam(parameters, **hparams.hparams)
+            return optim.Adam(parameters, **_fused_hparams(optim.Adam, parameters, hparams))
 
         elif hparams.name == 'AdamW':
-            return optim.AdamW(parameters, **hparams.hparams)
+            return optim.AdamW(parameters, **_fused_hparams(optim.AdamW, parameters, hparams))
 
         elif hparams.name == 'SparseAdam':
             return optim.SparseAdam(parameters, **hparams.hparams)
@@ -3,6 +3,7 @@ import numpy as np
 import torch
 import torch.distributed as dist
 import torch.nn as nn
+import torch.cuda.amp as amp
 from itertools import chain 
 from collections import OrderedDict, namedtuple
 from molecules.ml.unsupervised.point_autoencoder.hyperparams import AAE3dHyperparams
@@ -372,6 +373,10 @@ class AAE3d(object):
                      hparams = AAE3dHyperparams(),
                      optimizer_hparams = OptimizerHyperparams(),
                      gpu = None,
+                     enable_amp = False,
+                     amp_dtype = 'fp16',
+                     accum_steps = 1,
+                     cuda_graph = False,
                      init_weights=None,
                      verbose = True):
         """
@@ -403,6 +408,23 @@ class AAE3d(object):
             If int, the specified GPU.
             If tuple, the first and second GPUs respectively.
 
+        enable_amp: bool
+            Set to true to enable automatic mixed precision.
+
+        amp_dtype: str
+            Autocast precision, either 'fp16' or 'bf16'. With 'bf16' no
+            loss scaling is needed and the GradScaler is disabled.
+
+        accum_steps: int
+            Number of batches to accumulate gradients over before each
+            optimizer step. Gradients are only all-reduced on the last one.
+
+        cuda_graph: bool
+            Set to true to capture the training step in a CUDA graph after
+            a few warmup batches and replay it for all following batches.
+            Requires a single GPU, a constant batch shape, accum_steps=1,
+            no fp16 loss scaling and an optimizer supporting capturable=True.
+
         verbose : bool
             True prints training and validation loss to stdout.
         """
@@ -419,6 +441,15 @@ class AAE3d(object):
         # verbose level
         self.verbose = verbose
 
+        # mixed precision
+        if amp_dtype not in ('fp16', 'bf16'):
+            raise ValueError(f'Invalid amp_dtype {amp_dtype}. Should be fp16 or bf16.')
+        self.enable_amp = enable_amp
+        self.amp_dtype = torch.bfloat16 if amp_dtype == 'bf16' else torch.float16
+
+        # gradient accumulation
+        self.accum_steps = accum_steps
+
         # Tuple of encoder, decoder device
         self.devices = Device(*self._configure_device(gpu))
 
@@ -441,6 +472,16 @@ class AAE3d(object):
         self.optimizer_eg = get_optimizer(chain(self.model.encoder.parameters(), self.model.generator.parameters()), 
                                         optimizer_hparams)
 
+        # amp grad scaler, shared by both optimizers, only needed for fp16
+        self.gscaler = amp.GradScaler(enabled=self.enable_amp and (self.amp_dtype == torch.float16))
+
+        # cuda graph of the training step, captured lazily in _train
+        self.cuda_graph = cuda_graph
+        self.graph_warmup_steps = 3
+        self._graph = None
+        if self.cuda_graph:
+            self._check_cuda_graph()
+
         # loss parameters
         self.lambda_gp = hparams.lambda_gp
         self.lambda_rec = hparams.lambda_rec
@@ -487,6 +528,24 @@ class AAE3d(object):
     def __repr__(self):
         return str(self.model)
 
+    def _check_cuda_graph(self):
+        """
+        Verifies that the training step can be captured in a CUDA graph
+        and makes the optimizers keep their state on the GPU.
+        """
+        if (self.devices[0].type != 'cuda') or (len(set(self.devices)) != 1):
+            raise ValueError('CUDA graph capture requires encoder, generator and discriminator on the same GPU.')
+        if self.accum_steps != 1:
+            raise ValueError('CUDA graph capture does not support gradient accumulation.')
+        if self.gscaler.is_enabled():
+            raise ValueError('CUDA graph capture does not support fp16 loss scaling, use bf16 instead.')
+
+        for optimizer in [self.optimizer_d, self.optimizer_eg]:
+            if 'capturable' not in optimizer.defaults:
+                raise ValueError(f'Optimizer {type(optimizer).__name__} cannot be captured in a CUDA graph.')
+            for group in optimizer.param_groups:
+                group['capturable'] = True
+
     def _loss_fnc_d(self, noise, real_logits, codes, fake_logits):
 
         handle = self.model
@@ -497,16 +556,18 @@ class AAE3d(object):
         loss = torch.mean(fake_logits) - torch.mean(real_logits)
         
         # gradient penalty
-        alpha = torch.rand(self.batch_size, 1).to(self.devices[2])
-        interpolates = noise + alpha * (codes - noise)
+        alpha = torch.rand(self.batch_size, 1, device = self.devices[2])
+        interpolates = (noise + alpha * (codes - noise)).requires_grad_(True)
         disc_interpolates = handle.discriminate(interpolates)
         
-        gradients = torch.autograd.grad(outputs=disc_interpolates,
+        # scale the outputs to avoid underflow in the gradients under amp
+        gradients = torch.autograd.grad(outputs=self.gscaler.scale(disc_interpolates),
                                         inputs=interpolates,
                                         grad_outputs=torch.ones_like(disc_interpolates).to(self.devices[2]),
                                         create_graph=True,
                                         retain_graph=True,
                                         only_inputs=True)[0]
+        gradients = gradients / self.gscaler.get_scale()
         slopes = torch.sqrt(torch.sum(gradients ** 2, dim=1))
         gradient_penalty = ((slopes - 1) ** 2).mean()
         loss += self.lambda_gp * gradient_penalty
@@ -515,7 +576,10 @@ class AAE3d(object):
         
     def _loss_fnc_eg(self, data, rec_batch, fake_logit):        
         # reconstruction loss: here we need input shape (batch_size, num_points, points_dim)
-        loss = self.lambda_rec * torch.mean(self.rec_loss(rec_batch.permute(0, 2, 1), data.permute(0, 2, 1)))
+        # pairwise distances can overflow in half precision, compute them in fp32
+        with amp.autocast(enabled = False):
+            loss = self.lambda_rec * torch.mean(self.rec_loss(rec_batch.float().permute(0, 2, 1),
+                                                              data.float().permute(0, 2, 1)))
 
         # add generator loss if requested
         if fake_logit is not None:
@@ -523,7 +587,7 @@ class AAE3d(object):
         
         return loss
 
-    def train(self, train_loader, valid_loader, epochs=1, checkpoint='', callbacks=[]):
+    def train(self, train_loader, valid_loader, epochs=1, checkpoint='', callbacks=[], sampler=None):
         """
         Train model
 
@@ -545,6 +609,10 @@ class AAE3d(object):
         callbacks : list
             Contains molecules.utils.callback.Callback objects
             which are called during training.
+
+        sampler : torch.utils.data.distributed.DistributedSampler, None
+            Sampler of train_loader. If given, sampler.set_epoch(epoch)
+            is called each epoch so that the shuffling differs across epochs.
         """
         
         if callbacks:
@@ -567,6 +635,9 @@ class AAE3d(object):
         
         for epoch in range(start_epoch, epochs + 1):
 
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+
             for callback in callbacks:
                 callback.on_epoch_begin(epoch, logs)
 
@@ -602,9 +673,16 @@ class AAE3d(object):
         if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
             handle = handle.module
 
+        if self.cuda_graph and isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            raise ValueError('CUDA graph capture is not supported with DistributedDataParallel.')
+
         handle.train()
+        if self._graph is None:
+            self.optimizer_d.zero_grad()
+            self.optimizer_eg.zero_grad()
         train_loss_d = 0.
         train_loss_eg = 0.
+        n_batches = len(train_loader)
         for batch_idx, token in enumerate(train_loader):
             
             if self.verbose:
@@ -618,46 +696,19 @@ class AAE3d(object):
 
             # copy to gpu
             data, rmsd, fnc, index = token
-            data = data.to(self.devices[0])
+            data = data.to(self.devices[0], non_blocking = True)
                 
-            # get reconstruction
-            codes, mu, logvar = handle.encode(data)
-            
-            # get noise
-            self.noise.normal_(mean = self.noise_mu, std = self.noise_std)
-            
-            # get logits
-            real_logits = handle.discriminate(self.noise)
-            fake_logits = handle.discriminate(codes)
-            
-            # get loss
-            loss_d = self._loss_fnc_d(self.noise, real_logits, codes, fake_logits)
-            
-            # backward pass
-            self.optimizer_d.zero_grad()
-            handle.discriminator.zero_grad()
-            loss_d.backward(retain_graph = True)
-            
-            # optimizer step
+            # only all-reduce gradients on the last accumulation step
+            sync_step = ((batch_idx + 1) % self.accum_steps == 0) or (batch_idx + 1 == n_batches)
+            # the last window of the epoch may be shorter than accum_steps
+            window = min(self.accum_steps, n_batches - (batch_idx // self.accum_steps) * self.accum_steps)
+
+            if self.cuda_graph:
+                loss_d, loss_eg = self._graph_step(handle, data)
+            else:
+                loss_d, loss_eg = self._train_step(handle, data, sync_step, window)
             train_loss_d += loss_d.item()
-            self.optimizer_d.step()
-
-            # eg step
-            rec_batch = handle.generate(codes)
-            fake_logit = handle.discriminate(codes)
-            
-            # get loss
-            loss_eg = self._loss_fnc_eg(data, rec_batch, fake_logit)
-            
-            # backward pass
-            self.optimizer_eg.zero_grad()
-            handle.generator.zero_grad()
-            handle.encoder.zero_grad()
-            loss_eg.backward()
-            
-            # optimizer step
             train_loss_eg += loss_eg.item()
-            self.optimizer_eg.step()
 
             if callbacks:
                 logs['train_loss_d'] = loss_d.item()
@@ -667,7 +718,7 @@ class AAE3d(object):
             if self.verbose and (self.comm_rank == 0):
                 print('Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss_d: {:.6f}\tLoss_eg: {:.6f}\tTime: {:.3f}'.format(
                       epoch, (batch_idx + 1) * self.comm_size * len(data),
-                      self.comm_size * len(train_loader.dataset),
+                      self.comm_size * len(train_loader.sampler),
                       100. * (batch_idx + 1) / len(train_loader),
                       loss_d.item(), loss_eg.item(),
                       time.time() - start))
@@ -676,8 +727,8 @@ class AAE3d(object):
                 callback.on_batch_end(batch_idx, epoch, logs)
 
         # running loss over epoch
-        train_loss_d_ave = train_loss_d / float(batch_idx + 1)
-        train_loss_eg_ave = train_loss_eg / float(batch_idx + 1)
+        train_loss_d_ave = train_loss_d / float(n_batches)
+        train_loss_eg_ave = train_loss_eg / float(n_batches)
 
         if callbacks:
             logs['train_loss_d_average'] = train_loss_d_ave
@@ -687,6 +738,119 @@ class AAE3d(object):
             print('====> Epoch: {} Average loss_d: {:.4f} loss_eg: {:.4f}'.format(epoch, train_loss_d_ave, train_loss_eg_ave))
 
             
+    def _train_step(self, handle, data, sync_step, window=1):
+        """
+        Forward and backward pass of one batch for the discriminator and
+        the encoder/generator. If sync_step, the discriminator steps before
+        the encoder/generator pass, which therefore sees the updated critic,
+        and the encoder/generator steps after it. With accum_steps > 1 the
+        encoder/generator passes inside an accumulation window use the
+        critic of the previous window. The losses are divided by window,
+        the number of batches accumulated into the current step.
+
+        Returns
+        -------
+        Discriminator and encoder/generator loss tensors.
+        """
+        with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
+            # get reconstruction
+            codes, mu, logvar = handle.encode(data)
+
+            # get noise
+            self.noise.normal_(mean = self.noise_mu, std = self.noise_std)
+
+            # get logits, the critic step does not train the encoder
+            real_logits = handle.discriminate(self.noise)
+            fake_logits = handle.discriminate(codes.detach())
+
+            # get loss
+            loss_d = self._loss_fnc_d(self.noise, real_logits, codes.detach(), fake_logits)
+
+        # backward pass
+        self.gscaler.scale(loss_d / window).backward()
+
+        # optimizer step
+        if sync_step:
+            self._all_reduce_grads(handle.discriminator)
+            self.gscaler.step(self.optimizer_d)
+            self.optimizer_d.zero_grad()
+
+        # eg step, the discriminator weights are not trained here
+        handle.discriminator.requires_grad_(False)
+        with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
+            rec_batch = handle.generate(codes)
+            fake_logit = handle.discriminate(codes)
+
+            # get loss
+            loss_eg = self._loss_fnc_eg(data, rec_batch, fake_logit)
+
+        # backward pass
+        self.gscaler.scale(loss_eg / window).backward()
+        handle.discriminator.requires_grad_(True)
+
+        # optimizer step
+        if sync_step:
+            self._all_reduce_grads(handle.encoder, handle.generator)
+            self.gscaler.step(self.optimizer_eg)
+            self.gscaler.update()
+            self.optimizer_eg.zero_grad()
+
+        return loss_d, loss_eg
+
+    def _all_reduce_grads(self, *modules):
+        """
+        Averages the gradients of modules over all ranks. The forward
+        passes go through the wrapped module, which bypasses the gradient
+        hooks of DistributedDataParallel, so it never syncs them itself.
+        """
+        if not isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
+            return
+        grads = [p.grad for module in modules for p in module.parameters()
+                 if p.grad is not None]
+        works = [dist.all_reduce(grad, async_op = True) for grad in grads]
+        for work in works:
+            work.wait()
+        for grad in grads:
+            grad.div_(self.comm_size)
+
+    def _graph_step(self, handle, data):
+        """
+        Runs _train_step through a CUDA graph. The first batches run
+        eagerly on a side stream as warmup, the next one is captured
+        and every following batch only replays the graph.
+
+        Returns
+        -------
+        Discriminator and encoder/generator loss tensors, which are
+        overwritten by the next replay.
+        """
+        if self._graph is None:
+            if self.graph_warmup_steps > 0:
+                self.graph_warmup_steps -= 1
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    losses = self._train_step(handle, data, True)
+                torch.cuda.current_stream().wait_stream(stream)
+                return losses
+
+            # capture, the gradients are allocated from the graph memory pool
+            self._static_data = data.clone()
+            self.optimizer_d.zero_grad(set_to_none=True)
+            self.optimizer_eg.zero_grad(set_to_none=True)
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._static_losses = self._train_step(handle, self._static_data, True)
+        elif data.shape != self._static_data.shape:
+            # the graph is only valid for the captured batch shape
+            return self._train_step(handle, data, True)
+        else:
+            self._static_data.copy_(data, non_blocking=True)
+
+        # capturing does not execute the step, so replay for the current batch too
+        self._graph.replay()
+        return self._static_losses
+
     def _validate(self, valid_loader, epoch, callbacks, logs):
         """
         Test model on validation set.
@@ -716,12 +880,13 @@ class AAE3d(object):
             for batch_idx, token in enumerate(valid_loader):
                 # copy to gpu
                 data, rmsd, fnc, index = token
-                data = data.to(self.devices[0])
-                # get reconstruction
-                codes, mu, logvar = handle.encode(data)
-                # just reconstruction loss is important here
-                recons_batch = handle.generate(codes)
-                valid_loss += self._loss_fnc_eg(data, recons_batch, None).item()
+                data = data.to(self.devices[0], non_blocking = True)
+                with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
+                    # get reconstruction
+                    codes, mu, logvar = handle.encode(data)
+                    # just reconstruction loss is important here
+                    recons_batch = handle.generate(codes)
+                    valid_loss += self._loss_fnc_eg(data, recons_batch, None).item()
 
                 for callback in callbacks:
                     callback.on_validation_batch_end(epoch,
@@ -5,7 +5,6 @@ class ChamferLoss(nn.Module):
 
     def __init__(self):
         super(ChamferLoss, self).__init__()
-        self.use_cuda = torch.cuda.is_available()
 
     def forward(self, preds, gts):
         P = self.batch_pairwise_dist(gts, preds)
@@ -21,12 +20,8 @@ class ChamferLoss(nn.Module):
         xx = torch.bmm(x, x.transpose(2, 1))
         yy = torch.bmm(y, y.transpose(2, 1))
         zz = torch.bmm(x, y.transpose(2, 1))
-        if self.use_cuda:
-            dtype = torch.cuda.LongTensor
-        else:
-            dtype = torch.LongTensor
-        diag_ind_x = torch.arange(0, num_points_x).type(dtype)
-        diag_ind_y = torch.arange(0, num_points_y).type(dtype)
+        diag_ind_x = torch.arange(0, num_points_x, device=x.device)
+        diag_ind_y = torch.arange(0, num_points_y, device=y.device)
         rx = xx[:, diag_ind_x, diag_ind_x].unsqueeze(1).expand_as(
             zz.transpose(2, 1))
         ry = yy[:, diag_ind_y, diag_ind_y].unsqueeze(1).expand_as(zz)
@@ -1,4 +1,5 @@
 import time
+import contextlib
 import numpy as np
 import torch
 from torch import nn
@@ -8,6 +9,7 @@ from collections import namedtuple
 from .resnet import ResnetVAEHyperparams
 from .symmetric import SymmetricVAEHyperparams
 from molecules.ml.hyperparams import OptimizerHyperparams, get_optimizer
+from molecules.ml.datasets import to_model_input
 import torch.cuda.amp as amp
 
 __all__ = ["VAE"]
@@ -43,17 +45,42 @@ class VAEModel(nn.Module):
         self.decoder.to(device.decoder)
 
         self.device = device
+        self.same_device = device.encoder == device.decoder
+
+        # side streams for the encoder <-> decoder copies when split over GPUs
+        self.xfer_streams = None
+        if not self.same_device and (device.encoder.type == "cuda"):
+            self.xfer_streams = Device(
+                torch.cuda.Stream(device=device.encoder),
+                torch.cuda.Stream(device=device.decoder),
+            )
 
     def reparameterize(self, mu, logvar):
-        std = torch.exp(0.5 * logvar)
+        std = (0.5 * logvar).exp_()
         eps = torch.randn_like(std)
-        return mu + eps * std
+        return torch.addcmul(mu, eps, std)
+
+    def _transfer(self, x, device, stream):
+        # copy x to device on a side stream of its source device, the
+        # backward copy of the gradient runs on the same stream
+        if stream is None:
+            return x.to(device)
+        stream.wait_stream(torch.cuda.current_stream(x.device))
+        with torch.cuda.stream(stream):
+            y = x.to(device, non_blocking=True)
+        x.record_stream(stream)
+        torch.cuda.current_stream(device).wait_stream(stream)
+        return y
 
     def forward(self, x):
         # x should be placed on encoder gpu in the dataset class
+        enc_stream, dec_stream = self.xfer_streams or (None, None)
         mu, logvar = self.encoder(x)
-        z = self.reparameterize(mu, logvar).to(self.device.decoder)
-        x = self.decoder(z).to(self.device.encoder)
+        z = self.reparameterize(mu, logvar)
+        if self.same_device:
+            return self.decoder(z), z, mu, logvar
+        z = self._transfer(z, self.device.decoder, enc_stream)
+        x = self._transfer(self.decoder(z), self.device.encoder, dec_stream)
         return x, z, mu, logvar
 
     def encode(self, x):
@@ -72,6 +99,16 @@ class VAEModel(nn.Module):
         self.decoder.load_weights(dec_path)
 
 
+@torch.jit.script
+def kl_divergence(mu: torch.Tensor, logvar: torch.Tensor) -> torch.Tensor:
+    """
+    KL divergence to the standard normal, scripted so that the elementwise
+    part runs as one fused kernel followed by the reduction.
+    """
+    # 0.5 * mean(1 + log(sigma^2) - mu^2 - sigma^2)
+    return -0.5 * torch.mean(1 + logvar - mu * mu - logvar.exp())
+
+
 def vae_loss(recon_x, x, mu, logvar, reduction="mean"):
     """
     Effects
@@ -85,8 +122,7 @@ def vae_loss(recon_x, x, mu, logvar, reduction="mean"):
 
     BCE = F.binary_cross_entropy(recon_x, x, reduction=reduction)
 
-    # 0.5 * mean(1 + log(sigma^2) - mu^2 - sigma^2)
-    KLD = -0.5 * torch.mean(1 + logvar - mu.pow(2) - logvar.exp())
+    KLD = kl_divergence(mu, logvar)
 
     return BCE, KLD
 
@@ -97,12 +133,24 @@ def vae_logit_loss(logit_recon_x, x, mu, logvar, reduction="mean"):
     """
     BCE = F.binary_cross_entropy_with_logits(logit_recon_x, x, reduction=reduction)
 
-    # 0.5 * mean(1 + log(sigma^2) - mu^2 - sigma^2)
-    KLD = -0.5 * torch.mean(1 + logvar - mu.pow(2) - logvar.exp())
+    KLD = kl_divergence(mu, logvar)
 
     return BCE, KLD
 
 
+def vae_logit_loss_fused(logit_recon_x, x, mu, logvar, lambda_rec: float = 1.0):
+    """
+    As vae_logit_loss, but also returns the weighted total loss. Meant to be
+    wrapped in torch.compile, which generates a single kernel for the KLD
+    terms and folds the weighting into the reductions.
+    """
+    BCE = F.binary_cross_entropy_with_logits(logit_recon_x, x)
+    # inlined rather than kl_divergence, a scripted function breaks the graph
+    KLD = -0.5 * torch.mean(1 + logvar - mu * mu - logvar.exp())
+
+    return lambda_rec * BCE + KLD, BCE, KLD
+
+
 def vae_logit_loss_outlier_helper(
     logit_recon_x, x, mu, logvar, lambda_rec=1.0, reduction="mean"
 ):
@@ -110,12 +158,22 @@ def vae_logit_loss_outlier_helper(
     As above, but works directly on logits
     """
     BCE = F.binary_cross_entropy_with_logits(logit_recon_x, x, reduction=reduction)
-    # 0.5 * mean(1 + log(sigma^2) - mu^2 - sigma^2)
-    KLD = -0.5 * torch.mean(1 + logvar - mu.pow(2) - logvar.exp())
+    KLD = kl_divergence(mu, logvar)
 
     return lambda_rec * BCE, KLD
 
 
+def _implementing(callbacks, hook):
+    """Returns the callbacks which override the no-op `hook` of Callback."""
+    # Imported here since the callbacks package pulls in the plotting stack
+    from molecules.ml.callbacks.callback import Callback
+
+    base = getattr(Callback, hook)
+    return [
+        callback for callback in callbacks if getattr(type(callback), hook) is not base
+    ]
+
+
 # TODO: set weight initialization hparams
 class VAE:
     """
@@ -160,8 +218,14 @@ class VAE:
         loss=None,
         gpu=None,
         enable_amp=False,
+        amp_dtype="fp16",
+        accum_steps=1,
+        max_grad_norm=None,
+        channels_last=False,
+        enable_compile=False,
         init_weights=None,
         verbose=True,
+        log_interval=100,
     ):
         """
         Parameters
@@ -185,6 +249,26 @@ class VAE:
         enable_amp: bool
             Set to true to enable automatic mixed precision.
 
+        amp_dtype: str
+            Autocast precision, either 'fp16' or 'bf16'. With 'bf16' no
+            loss scaling is needed and the GradScaler is disabled.
+
+        accum_steps: int
+            Number of batches to accumulate gradients over before each
+            optimizer step. Gradients are only all-reduced on the last one.
+
+        max_grad_norm: float, None
+            If given, gradients are unscaled and clipped to this total
+            norm before each optimizer step.
+
+        channels_last: bool
+            Set to true to run the conv2d layers of the SymmetricVAE in
+            channels_last (NHWC) memory format. Ignored for ResnetVAE.
+
+        enable_compile: bool
+            Set to true to wrap the model in torch.compile, which fuses
+            the small encoder/decoder ops into generated kernels.
+
         gpu : int, tuple, or None
             Encoder and decoder will train on ...
             If None, cuda GPU device if it is available, otherwise CPU.
@@ -198,29 +282,59 @@ class VAE:
 
         verbose : bool
             True prints training and validation loss to stdout.
+
+        log_interval : int
+            Print the training loss and the average time per batch every
+            log_interval batches. Every print synchronizes with the GPU.
         """
 
         hparams.validate()
         optimizer_hparams.validate()
 
+        if amp_dtype not in ("fp16", "bf16"):
+            raise ValueError(f"Invalid amp_dtype {amp_dtype}. Should be fp16 or bf16.")
+
         self.enable_amp = enable_amp
+        self.amp_dtype = torch.bfloat16 if amp_dtype == "bf16" else torch.float16
+        # binary inputs are exact in half precision, cast them on the device
+        self.input_dtype = self.amp_dtype if self.enable_amp else torch.float32
+        self.accum_steps = accum_steps
+        self.max_grad_norm = max_grad_norm
         self.verbose = verbose
+        self.log_interval = log_interval
 
         # Tuple of encoder, decoder device
         self.device = Device(*self._configure_device(gpu))
 
+        self.input_shape = tuple(input_shape)
         self.model = VAEModel(input_shape, hparams, init_weights, self.device)
 
+        # NHWC layout only applies to the 4D inputs of the conv2d models
+        self.memory_format = torch.preserve_format
+        if channels_last and isinstance(hparams, SymmetricVAEHyperparams):
+            self.memory_format = torch.channels_last
+            self.model = self.model.to(memory_format=self.memory_format)
+
+        if enable_compile:
+            self.model = torch.compile(self.model, dynamic=False)
+
         # TODO: consider making optimizer_hparams a member variable
         # RMSprop with lr=0.001, alpha=0.9, epsilon=1e-08, decay=0.0
         self.optimizer = get_optimizer(self.model.parameters(), optimizer_hparams)
 
-        # amp grad scaler
-        self.gscaler = amp.GradScaler(enabled=self.enable_amp)
+        # amp grad scaler, only needed for fp16
+        self.gscaler = amp.GradScaler(
+            enabled=self.enable_amp and self.amp_dtype == torch.float16
+        )
 
         self.loss_fnc = vae_logit_loss if loss is None else loss
         self.lambda_rec = hparams.lambda_rec
 
+        # compile the default loss with the model, custom losses run as is
+        self.fused_loss_fnc = None
+        if enable_compile and loss is None:
+            self.fused_loss_fnc = torch.compile(vae_logit_loss_fused, dynamic=False)
+
         # these are helpers for distributed computing
         self.comm_rank = 0
         self.comm_size = 1
@@ -264,8 +378,28 @@ class VAE:
     def __repr__(self):
         return str(self.model)
 
+    def _get_handle(self):
+        """
+        Returns the underlying VAEModel, unwrapping DistributedDataParallel
+        and the OptimizedModule returned by torch.compile.
+        """
+        handle = self.model
+        while True:
+            if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
+                handle = handle.module
+            elif hasattr(handle, "_orig_mod"):
+                handle = handle._orig_mod
+            else:
+                return handle
+
     def train(
-        self, train_loader, valid_loader, epochs=1, checkpoint=None, callbacks=[]
+        self,
+        train_loader,
+        valid_loader,
+        epochs=1,
+        checkpoint=None,
+        callbacks=[],
+        sampler=None,
     ):
         """
         Train model
@@ -288,12 +422,14 @@ class VAE:
         callbacks : list
             Contains molecules.utils.callback.Callback objects
             which are called during training.
+
+        sampler : torch.utils.data.distributed.DistributedSampler, None
+            Sampler of train_loader. If given, sampler.set_epoch(epoch)
+            is called each epoch so that the shuffling differs across epochs.
         """
 
         if callbacks:
-            handle = self.model
-            if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-                handle = handle.module
+            handle = self._get_handle()
             logs = {"model": handle, "optimizer": self.optimizer}
             if dist.is_initialized():
                 logs["comm_size"] = self.comm_size
@@ -310,6 +446,9 @@ class VAE:
 
         for epoch in range(start_epoch, epochs + 1):
 
+            if sampler is not None:
+                sampler.set_epoch(epoch)
+
             for callback in callbacks:
                 callback.on_epoch_begin(epoch, logs)
 
@@ -322,6 +461,25 @@ class VAE:
         for callback in callbacks:
             callback.on_train_end(logs)
 
+    def _to_device(self, data):
+        """
+        Asynchronously copies a pinned batch to the encoder device and
+        casts it there. Bit packed contact maps (torch.uint8 with a last
+        dimension of ceil(W / 8)) are unpacked on the device.
+        """
+        data = data.to(self.device[0], non_blocking=True)
+        data = to_model_input(data, self.input_shape, self.input_dtype)
+        return data.to(memory_format=self.memory_format)
+
+    def _compute_loss(self, logit_recon_batch, data, mu, logvar):
+        """Returns the total, reconstruction and KLD losses."""
+        if self.fused_loss_fnc is not None:
+            return self.fused_loss_fnc(
+                logit_recon_batch, data, mu, logvar, self.lambda_rec
+            )
+        loss_rec, loss_kld = self.loss_fnc(logit_recon_batch, data, mu, logvar)
+        return self.lambda_rec * loss_rec + loss_kld, loss_rec, loss_kld
+
     def _train(self, train_loader, epoch, callbacks, logs):
         """
         Train for 1 epoch
@@ -343,60 +501,104 @@ class VAE:
         """
 
         self.model.train()
-        train_loss = 0.0
+        self.optimizer.zero_grad(set_to_none=True)
+        # accumulate on the device to avoid a sync per batch
+        train_loss = torch.zeros((), device=self.device[0])
+        n_batches = len(train_loader)
+        n_samples = self.comm_size * len(train_loader.sampler)
+        batch_begin_callbacks = _implementing(callbacks, "on_batch_begin")
+        batch_end_callbacks = _implementing(callbacks, "on_batch_end")
+        start, last_logged = time.time(), -1
         for batch_idx, token in enumerate(train_loader):
 
             data, rmsd, fnc, index = token
-            data = data.to(self.device[0])
-
-            if self.verbose:
-                start = time.time()
+            data = self._to_device(data)
 
-            if callbacks:
-                pass  # TODO: add more to logs
-
-            for callback in callbacks:
+            for callback in batch_begin_callbacks:
                 callback.on_batch_begin(batch_idx, epoch, logs)
 
-            # forward
-            with amp.autocast(self.enable_amp):
-                logit_recon_batch, codes, mu, logvar = self.model(data)
-                loss_rec, loss_kld = self.loss_fnc(logit_recon_batch, data, mu, logvar)
-                loss = self.lambda_rec * loss_rec + loss_kld
-
-            # backward
-            self.optimizer.zero_grad()
-            self.gscaler.scale(loss).backward()
-            self.gscaler.step(self.optimizer)
-            self.gscaler.update()
+            # only all-reduce gradients on the last accumulation step
+            sync_step = ((batch_idx + 1) % self.accum_steps == 0) or (
+                batch_idx + 1 == n_batches
+            )
+            # the last window of the epoch may be shorter than accum_steps
+            window = min(
+                self.accum_steps,
+                n_batches - (batch_idx // self.accum_steps) * self.accum_steps,
+            )
+            if not sync_step and isinstance(
+                self.model, torch.nn.parallel.DistributedDataParallel
+            ):
+                sync_context = self.model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+
+            with sync_context:
+                # forward
+                with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
+                    logit_recon_batch, codes, mu, logvar = self.model(data)
+                    loss, loss_rec, loss_kld = self._compute_loss(
+                        logit_recon_batch, data, mu, logvar
+                    )
 
-            # update loss
-            train_loss += loss.item()
+                # backward
+                self.gscaler.scale(loss / window).backward()
 
-            if callbacks:
-                logs["train_loss"] = loss.item()
-                logs["train_loss_rec"] = loss_rec.item()
-                logs["train_loss_kld"] = loss_kld.item()
-                logs["global_step"] = (epoch - 1) * len(train_loader) + batch_idx
+            if sync_step:
+                if self.max_grad_norm is not None:
+                    # clip the true gradients, step skips the update on inf/nan
+                    self.gscaler.unscale_(self.optimizer)
+                    torch.nn.utils.clip_grad_norm_(
+                        self.model.parameters(), self.max_grad_norm
+                    )
+                self.gscaler.step(self.optimizer)
+                self.gscaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
 
-            if self.verbose and (self.comm_rank == 0):
+            # update loss
+            train_loss += loss.detach()
+
+            # the other callbacks only read the logs of the last batch
+            if (
+                batch_begin_callbacks
+                or batch_end_callbacks
+                or (callbacks and batch_idx + 1 == n_batches)
+            ):
+                logs["train_loss"] = loss.detach()
+                logs["train_loss_rec"] = loss_rec.detach()
+                logs["train_loss_kld"] = loss_kld.detach()
+                logs["global_step"] = (epoch - 1) * n_batches + batch_idx
+
+            if (
+                self.verbose
+                and (self.comm_rank == 0)
+                and (batch_idx % self.log_interval == 0)
+            ):
+                # item() waits for the queued batches, so the time per batch
+                # since the last print is measured on finished work
+                loss_value = loss.item()
+                batch_time = (time.time() - start) / (batch_idx - last_logged)
+                start, last_logged = time.time(), batch_idx
                 print(
                     "Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\tTime: {:.3f}".format(
                         epoch,
                         (batch_idx + 1) * self.comm_size * len(data),
-                        self.comm_size * len(train_loader.dataset),
-                        100.0 * (batch_idx + 1) / len(train_loader),
-                        loss.item(),
-                        time.time() - start,
+                        n_samples,
+                        100.0 * (batch_idx + 1) / n_batches,
+                        loss_value,
+                        batch_time,
                     )
                 )
 
-            for callback in callbacks:
+            for callback in batch_end_callbacks:
                 callback.on_batch_end(batch_idx, epoch, logs)
 
-        train_loss_ave = train_loss / float(batch_idx + 1)
+        train_loss_ave = (train_loss / n_batches).item()
 
         if callbacks:
+            # callbacks expect python floats, sync once per epoch
+            for lossname in ["train_loss", "train_loss_rec", "train_loss_kld"]:
+                logs[lossname] = logs[lossname].item()
             logs["train_loss_average"] = train_loss_ave
 
         if self.verbose and (self.comm_rank == 0):
@@ -419,25 +621,26 @@ class VAE:
             Filled with data for callbacks
         """
         self.model.eval()
-        valid_loss = 0
+        # accumulate on the device to avoid a sync per batch
+        valid_loss = torch.zeros((), device=self.device[0])
+        n_batches = len(valid_loader)
         for callback in callbacks:
             callback.on_validation_begin(epoch, logs)
+        batch_end_callbacks = _implementing(callbacks, "on_validation_batch_end")
 
         with torch.no_grad():
             for batch_idx, token in enumerate(valid_loader):
                 data, rmsd, fnc, index = token
-                data = data.to(self.device[0])
+                data = self._to_device(data)
 
-                with amp.autocast(self.enable_amp):
+                with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
                     logit_recon_batch, codes, mu, logvar = self.model(data)
-                    valid_loss_rec, valid_loss_kld = self.loss_fnc(
+                    loss, _, _ = self._compute_loss(
                         logit_recon_batch, data, mu, logvar
                     )
-                    valid_loss += (
-                        self.lambda_rec * valid_loss_rec + valid_loss_kld
-                    ).item()
+                    valid_loss += loss.detach()
 
-                for callback in callbacks:
+                for callback in batch_end_callbacks:
                     callback.on_validation_batch_end(
                         epoch,
                         batch_idx,
@@ -447,7 +650,7 @@ class VAE:
                         mu=mu.detach(),
                     )
 
-        valid_loss /= float(batch_idx + 1)
+        valid_loss = (valid_loss / n_batches).item()
 
         if callbacks:
             logs["valid_loss"] = valid_loss
@@ -459,25 +662,40 @@ class VAE:
             print("====> Validation loss: {:.4f}".format(valid_loss))
 
     def compute_losses(self, data_loader, checkpoint):
+        """
+        Computes the BCE and KLD loss of every batch of data_loader
+        with the weights of checkpoint.
+
+        Returns
+        -------
+        Lists of the per batch BCE and KLD losses and the list of the
+        dataset indices of all samples, in loader order.
+        """
         self._load_checkpoint(checkpoint)
         self.model.eval()
-        bce_losses, kld_losses, indices = [], [], []
+        # per batch losses stay on the device the loss is computed on,
+        # which is the encoder device, and are copied back once
+        bce_losses = torch.empty(len(data_loader), device=self.device.encoder)
+        kld_losses = torch.empty(len(data_loader), device=self.device.encoder)
+        indices = torch.empty(len(data_loader.dataset), dtype=torch.long)
+        n_samples = 0
         with torch.no_grad():
             for batch_idx, token in enumerate(data_loader):
                 data, rmsd, fnc, index = token
-                data = data.to(self.device[0])
+                data = self._to_device(data)
 
-                with amp.autocast(self.enable_amp):
+                with amp.autocast(self.enable_amp, dtype=self.amp_dtype):
                     logit_recon_batch, codes, mu, logvar = self.model(data)
                     bce_loss, kld_loss = vae_logit_loss_outlier_helper(
                         logit_recon_batch, data, mu, logvar, self.lambda_rec
                     )
 
-                bce_losses.append(bce_loss.item())
-                kld_losses.append(kld_loss.item())
-                indices.append(index)
+                bce_losses[batch_idx] = bce_loss
+                kld_losses[batch_idx] = kld_loss
+                indices[n_samples : n_samples + len(index)] = index
+                n_samples += len(index)
 
-        return bce_losses, kld_losses, indices
+        return bce_losses.tolist(), kld_losses.tolist(), indices[:n_samples].tolist()
 
     def _load_checkpoint(self, path):
         """
@@ -498,9 +716,7 @@ class VAE:
         cp = torch.load(path, map_location="cpu")
 
         # model
-        handle = self.model
-        if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-            handle = handle.module
+        handle = self._get_handle()
         handle.encoder.load_state_dict(cp["encoder_state_dict"])
         handle.decoder.load_state_dict(cp["decoder_state_dict"])
 
@@ -523,9 +739,7 @@ class VAE:
         torch.Tensor of embeddings of shape (batch-size, latent_dim)
 
         """
-        handle = self.model
-        if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-            handle = handle.module
+        handle = self._get_handle()
         return handle.encode(x)
 
     def decode(self, embedding):
@@ -542,9 +756,7 @@ class VAE:
         -------
         torch.Tensor of generated matrices of shape (batch-size, input_shape)
         """
-        handle = self.model
-        if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-            handle = handle.module
+        handle = self._get_handle()
         return handle.decode(embedding)
 
     def save_weights(self, enc_path, dec_path):
@@ -559,9 +771,7 @@ class VAE:
         dec_path : str
             Path to save the decoder weights.
         """
-        handle = self.model
-        if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-            handle = handle.module
+        handle = self._get_handle()
         handle.save_weights(enc_path, dec_path)
 
     def load_weights(self, enc_path, dec_path):
@@ -576,7 +786,5 @@ class VAE:
         dec_path : str
             Path to save the decoder weights.
         """
-        handle = self.model
-        if isinstance(handle, torch.nn.parallel.DistributedDataParallel):
-            handle = handle.module
+        handle = self._get_handle()
         handle.load_weights(enc_path, dec_path)
@@ -1,45 +1,282 @@
+import io
 import os
 import time
+import hashlib
+import importlib.util
+import inspect
+import concurrent.futures as cf
 import wandb
-from typing import List, Tuple, Dict
+from typing import Any, List, Tuple, Dict, Optional
 from PIL import Image
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import h5py
 from molecules.data.utils import parse_h5
 
 
+# number of points above which plot_tsne draws hexbin plots
+HEXBIN_THRESHOLD = 20000
+
+# number of t-SNE results compute_tsne keeps in a cache_dir
+TSNE_CACHE_SIZE = 16
+
+CMAP = plt.get_cmap("jet")
+
+# serializes and uploads the wandb point clouds while plotting goes on,
+# a single worker keeps the logs in order
+_WANDB_EXECUTOR = cf.ThreadPoolExecutor(max_workers=1)
+
+
+def _log_object3d(key: str, point_data: np.ndarray, caption: str, step: int):
+    wandb.log({key: wandb.Object3D(point_data, caption=caption)}, step=step)
+
+
+def _to_rgba(color_arr: np.ndarray, vmin: float, vmax: float) -> np.ndarray:
+    r"""Maps `color_arr` to RGBA colors with a single lookup into the table
+    of CMAP, same as ScalarMappable.to_rgba without the per call overhead."""
+    scale = CMAP.N / (vmax - vmin) if vmax > vmin else 0.0
+    # integer inputs index the lookup table directly
+    lut_inds = np.clip((color_arr - vmin) * scale, 0, CMAP.N - 1).astype(np.intp)
+    return CMAP(lut_inds)
+
+
+def _save_npy(path: str, arr: np.ndarray):
+    r"""Writes and renames, concurrent plots may read the same file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+
+def _cuda_available() -> bool:
+    r"""True if a CUDA device is visible, the GPU backends crash otherwise."""
+    try:
+        import torch
+    except ImportError:
+        return False
+    return torch.cuda.is_available()
+
+
+def _evict_cache(cache_dir: str, keep: int = TSNE_CACHE_SIZE):
+    r"""Removes all but the `keep` most recently used t-SNE results, the
+    warm start inputs are kept."""
+    entries = [
+        entry
+        for entry in os.scandir(cache_dir)
+        if entry.name.endswith(".npy")
+        and not entry.name.startswith("previous-")
+        and ".tmp." not in entry.name
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            # removed by a concurrent plot
+            pass
+
+
+def _tsne_backend(backend: str, n_components: int) -> str:
+    r"""Resolve the `auto` t-SNE backend."""
+    if backend == "auto":
+        backend = "sklearn"
+        if importlib.util.find_spec("openTSNE") is not None:
+            backend = "opentsne"
+        if n_components == 2 and _cuda_available():
+            if importlib.util.find_spec("tsnecuda") is not None:
+                backend = "tsnecuda"
+            elif importlib.util.find_spec("cuml") is not None:
+                backend = "cuml"
+    return backend
+
+
+def _tsne_params(
+    backend: str, n_components: int, perplexity: float, init: Optional[np.ndarray]
+) -> Dict[str, Any]:
+    r"""The keyword arguments of the TSNE class of `backend`, everything
+    which changes the result, warm started from `init` if given."""
+    params = {"n_components": n_components, "perplexity": perplexity}
+    if backend == "sklearn":
+        if init is not None:
+            from sklearn.manifold import TSNE
+
+            # n_iter was renamed to max_iter in sklearn 1.5
+            iter_arg = "max_iter"
+            if "max_iter" not in inspect.signature(TSNE).parameters:
+                iter_arg = "n_iter"
+            params.update({"init": init, "early_exaggeration": 1.0, iter_arg: 500})
+    elif backend == "opentsne":
+        # FFT accelerated gradients only exist for up to 2 dimensions
+        params.update(
+            {
+                "negative_gradient_method": "fft" if n_components <= 2 else "bh",
+                "neighbors": "annoy",
+            }
+        )
+        if init is not None:
+            params.update(
+                {
+                    "initialization": init,
+                    "early_exaggeration_iter": 0,
+                    "exaggeration": None,
+                    "n_iter": 250,
+                }
+            )
+    elif backend == "cuml":
+        # "exact" is O(N^2), FFT interpolation is the fastest solver
+        params["method"] = "fft"
+    elif backend != "tsnecuda":
+        raise ValueError(f"TSNE backend {backend} not supported.")
+    return params
+
+
 def compute_tsne(
     data: np.ndarray,
     n_components: int = 3,
     n_jobs: int = 4,
     perplexity: float = 30.0,
-    backend: str = "sklearn",
+    backend: str = "auto",
+    cache_dir: Optional[str] = None,
+    warm_start: bool = False,
 ) -> np.ndarray:
-    r"""Run tsne on `data`."""
+    r"""Run tsne on `data`.
+
+    `backend` may be `sklearn`, `opentsne`, `tsnecuda`, `cuml` or `auto`.
+    The GPU backends only support `n_components=2`, `auto` uses tsne-cuda
+    or cuML for those when installed and a GPU is available, then openTSNE,
+    then sklearn.
+
+    If `cache_dir` is given, the result is stored there as .npy keyed by
+    a hash of `data`, the backend and all of its parameters which change
+    the result, and reloaded instead of recomputed when the same embeddings
+    are passed again, e.g. when one embeddings file is plotted more than
+    once. Only the TSNE_CACHE_SIZE most recently used results are kept.
+
+    If `warm_start` is set, the sklearn and openTSNE backends start from
+    the last result for the same `n_components` and `perplexity` in
+    `cache_dir`, which is then required, with half the iterations and
+    without early exaggeration, which would distort the converged layout,
+    e.g. to embed slightly changed embeddings of the same points after
+    every epoch.
+    """
+    if warm_start and cache_dir is None:
+        raise ValueError("TSNE warm_start requires a cache_dir.")
+
+    backend = _tsne_backend(backend, n_components)
+    if backend in ("tsnecuda", "cuml") and n_components != 2:
+        raise ValueError(f"TSNE backend {backend} only supports n_components=2.")
+
+    init = None
+    if warm_start:
+        init_path = os.path.join(
+            cache_dir, f"previous-{n_components}d-perplexity-{perplexity}.npy"
+        )
+        if os.path.exists(init_path):
+            init = np.load(init_path)
+            if len(init) != len(data):
+                init = None
+
+    params = _tsne_params(backend, n_components, perplexity, init)
+
+    if cache_dir is not None:
+        digest = hashlib.blake2b(
+            np.ascontiguousarray(data).tobytes(), digest_size=16
+        )
+        digest.update(f"{data.shape}-{data.dtype}-{backend}".encode())
+        for key, value in sorted(params.items()):
+            digest.update(key.encode())
+            if isinstance(value, np.ndarray):
+                digest.update(np.ascontiguousarray(value).tobytes())
+            else:
+                digest.update(repr(value).encode())
+        cache_path = os.path.join(
+            cache_dir,
+            f"{digest.hexdigest()}-{n_components}d-perplexity-{perplexity}.npy",
+        )
+        try:
+            # mark as recently used
+            os.utime(cache_path)
+            return np.load(cache_path)
+        except FileNotFoundError:
+            # not cached, or evicted by a concurrent plot
+            pass
+
     if backend == "sklearn":
         from sklearn.manifold import TSNE
 
-        tsne = TSNE(n_components=n_components, n_jobs=n_jobs, perplexity=perplexity)
-    elif backend == "cuml":
+        tsne = TSNE(n_jobs=n_jobs, **params)
+    elif backend == "opentsne":
+        from openTSNE import TSNE
+
+        tsne = TSNE(n_jobs=n_jobs, **params)
+    elif backend == "tsnecuda":
+        from tsnecuda import TSNE
+
+        tsne = TSNE(**params)
+    else:
         from cuml.manifold import TSNE
 
-        tsne = TSNE(n_components=n_components, method="exact", perplexity=perplexity)
+        tsne = TSNE(**params)
+
+    if backend == "opentsne":
+        tsne_embeddings = np.asarray(tsne.fit(data))
     else:
-        raise ValueError(f"TSNE backend {backend} not supported.")
+        tsne_embeddings = tsne.fit_transform(data)
+
+    if cache_dir is not None:
+        _save_npy(cache_path, tsne_embeddings)
+        _evict_cache(cache_dir)
+        if warm_start:
+            _save_npy(init_path, tsne_embeddings)
 
-    tsne_embeddings = tsne.fit_transform(data)
     return tsne_embeddings
 
 
 def compute_pca(embeddings: np.ndarray, dim: int = 50) -> np.ndarray:
-    # TODO: use pca to drop embeddings to dim 50
-    # TODO: run PCA in pytorch and reduce dimension down to 50 (maybe even lower)
-    #       then run tSNE on outputs of PCA. This works for sparse matrices
-    #       https://pytorch.org/docs/master/generated/torch.pca_lowrank.html
-    return embeddings
+    r"""Project `embeddings` onto their first `dim` principal components,
+    on the GPU when one is available."""
+    import torch
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    x = torch.as_tensor(embeddings, dtype=torch.float32, device=device)
+    _, _, v = torch.pca_lowrank(x, q=dim, center=True, niter=2)
+    x = (x - x.mean(dim=0)) @ v[:, :dim]
+    return x.cpu().numpy()
+
+
+def _scatter(ax, x, y, color, color_arr, scalar_map, alpha=None):
+    r"""Scatter plot, large point clouds are binned into a hexbin plot
+    colored by the mean of `color_arr` instead of drawing every point."""
+    if len(x) > HEXBIN_THRESHOLD:
+        ax.hexbin(
+            x,
+            y,
+            C=color_arr,
+            gridsize=200,
+            cmap=scalar_map.get_cmap(),
+            norm=scalar_map.norm,
+        )
+    else:
+        ax.scatter(x, y, marker=".", c=color, alpha=alpha, rasterized=True)
+
+
+def _save_figure(
+    fig, path: str, dpi: int = 300, compress_level: int = 6
+) -> io.BytesIO:
+    r"""Renders `fig` to PNG once, writes it to `path` and returns the
+    buffer, so that it can be logged without reading the file back."""
+    buf = io.BytesIO()
+    fig.savefig(
+        buf, format="png", dpi=dpi, pil_kwargs={"compress_level": compress_level}
+    )
+    with open(path, "wb") as f:
+        f.write(buf.getbuffer())
+    buf.seek(0)
+    return buf
 
 
 def plot_tsne(
@@ -52,6 +289,10 @@ def plot_tsne(
     perplexities: List[int] = [5, 30, 50, 100, 200],
     pca_dim: int = 50,
     plot_backend: str = "mpl",
+    tsne_backend: str = "auto",
+    dpi: int = 150,
+    cache_dir: Optional[str] = None,
+    warm_start: bool = False,
     outlier_inds=None,
     wandb_config=None,
     global_step=0,
@@ -62,9 +303,25 @@ def plot_tsne(
     ----------
     plot_backend: str
             Specify plotting backend as `mpl` for matplotlib or `plotly` for plotly.
+    tsne_backend: str
+            Specify t-SNE backend as `sklearn`, `opentsne`, `tsnecuda`, `cuml` or
+            `auto` to use the fastest installed backend.
+    dpi: int
+            Resolution of the saved plots. They are written with fast zlib
+            compression, use plot_tsne_publication for archival quality.
+    cache_dir: str
+            Directory to keep the t-SNE results in, so that an embeddings file
+            plotted again is not recomputed. Off by default.
+    warm_start: bool
+            Start each t-SNE from the result of the previous call with the same
+            cache_dir, for plots of the same points after every epoch. Off by
+            default, with it each plot depends on the previous ones.
     """
 
-    color_arrays = parse_h5(embeddings_path, fields=colors + ["embeddings"])
+    # all t-SNE backends work in single precision, read everything as float32
+    color_arrays = parse_h5(
+        embeddings_path, fields=colors + ["embeddings"], dtype=np.float32
+    )
     embeddings = color_arrays.pop("embeddings")
 
     if pca and embeddings.shape[1] > pca_dim:
@@ -73,7 +330,12 @@ def plot_tsne(
     if plot_backend == "plotly":
         from plotly.io import to_html
 
-        tsne_embeddings = compute_tsne(embeddings)
+        tsne_embeddings = compute_tsne(
+            embeddings,
+            backend=tsne_backend,
+            cache_dir=cache_dir,
+            warm_start=warm_start,
+        )
         fig = plot_tsne_plotly(tsne_embeddings, df_dict=color_arrays, color=colors[0])
         html_string = to_html(fig)
         if wandb_config is not None:
@@ -96,77 +358,85 @@ def plot_tsne(
     alpha = 0.3 if outlier_inds is not None else None
 
     # Precompute tsne embeddings for each perplexity
-    tsne_embeddings = []
-    for perplexity in perplexities:
-        tsne_embed = compute_tsne(
-            embeddings,
-            n_components=int(projection_type[0]),
-            n_jobs=4,
-            perplexity=perplexity,
+    tsne_kwargs = {
+        "n_components": int(projection_type[0]),
+        "n_jobs": 4,
+        "backend": _tsne_backend(tsne_backend, int(projection_type[0])),
+        "cache_dir": cache_dir,
+        "warm_start": warm_start,
+    }
+    max_workers = min(len(perplexities), (os.cpu_count() or 1) // 4)
+    if tsne_kwargs["backend"] in ("sklearn", "opentsne") and max_workers > 1:
+        from joblib import Parallel, delayed
+
+        # the CPU fits are independent, run them side by side. loky workers
+        # are not forked from the training process, and large embeddings are
+        # passed to them as a shared read only memmap instead of pickled
+        tsne_embeddings = Parallel(n_jobs=max_workers, backend="loky", mmap_mode="r")(
+            delayed(compute_tsne)(embeddings, perplexity=perplexity, **tsne_kwargs)
+            for perplexity in perplexities
         )
-        tsne_embeddings.append(tsne_embed)
-
-    for color_name, color_arr in color_arrays.items():
+    else:
+        tsne_embeddings = [
+            compute_tsne(embeddings, perplexity=perplexity, **tsne_kwargs)
+            for perplexity in perplexities
+        ]
+
+    # axis limits of each embedding, shared by all colors
+    tsne_limits = [
+        list(zip(emb_trans.min(axis=0) * 0.95, emb_trans.max(axis=0) * 1.05))
+        for emb_trans in tsne_embeddings
+    ]
+
+    # create one figure for all colors, each color gets ncols columns.
+    # rendered by Agg without going through pyplot
+    fig = Figure(figsize=(len(color_arrays) * ncols * 4, nrows * 4))
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(nrows=nrows, ncols=len(color_arrays) * ncols, squeeze=False)
+
+    wandb_futures = []
+    for idc, (color_name, color_arr) in enumerate(color_arrays.items()):
 
         # create colormaps
-        cmi = plt.get_cmap("jet")
         vmin, vmax = np.min(color_arr), np.max(color_arr)
         cnorm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
-        scalar_map = matplotlib.cm.ScalarMappable(norm=cnorm, cmap=cmi)
+        scalar_map = matplotlib.cm.ScalarMappable(norm=cnorm, cmap=CMAP)
         scalar_map.set_array(color_arr)
 
-        # create figure
-        fig, axs = plt.subplots(
-            figsize=(ncols * 4, nrows * 4), nrows=nrows, ncols=ncols
-        )
-
         # set up constants
-        color = scalar_map.to_rgba(color_arr)
+        col = idc * ncols
+        color = _to_rgba(color_arr, vmin, vmax)
         if color_name == "rmsd":
             titlestring = f"RMSD to reference state after epoch {epoch}"
         elif color_name == "fnc":
             titlestring = f"Fraction of contacts to reference state after epoch {epoch}"
 
-        for idr, (perplexity, emb_trans) in enumerate(
-            zip(perplexities, tsne_embeddings)
+        for idr, (perplexity, emb_trans, limits) in enumerate(
+            zip(perplexities, tsne_embeddings, tsne_limits)
         ):
 
             # plot
             if projection_type == "3d":
                 z1, z2, z3 = emb_trans[:, 0], emb_trans[:, 1], emb_trans[:, 2]
-                z1mm = np.min(z1), np.max(z1)
-                z2mm = np.min(z2), np.max(z2)
-                z3mm = np.min(z3), np.max(z3)
-                z1mm = (z1mm[0] * 0.95, z1mm[1] * 1.05)
-                z2mm = (z2mm[0] * 0.95, z2mm[1] * 1.05)
-                z3mm = (z3mm[0] * 0.95, z3mm[1] * 1.05)
+                z1mm, z2mm, z3mm = limits
                 # x-y
-                ax1 = axs[idr, 0]
-                ax1.scatter(z1, z2, marker=".", c=color, alpha=alpha)
-                ax1.set_xlim(z1mm)
-                ax1.set_ylim(z2mm)
-                ax1.set_xlabel(r"$z_1$")
-                ax1.set_ylabel(r"$z_2$")
+                ax1 = axs[idr, col]
+                _scatter(ax1, z1, z2, color, color_arr, scalar_map, alpha)
+                ax1.set(xlim=z1mm, ylim=z2mm, xlabel=r"$z_1$", ylabel=r"$z_2$")
                 # x-z
-                ax2 = axs[idr, 1]
-                ax2.scatter(z1, z3, marker=".", c=color, alpha=alpha)
-                ax2.set_xlim(z1mm)
-                ax2.set_ylim(z3mm)
-                ax2.set_xlabel(r"$z_1$")
-                ax2.set_ylabel(r"$z_3$")
+                ax2 = axs[idr, col + 1]
+                _scatter(ax2, z1, z3, color, color_arr, scalar_map, alpha)
+                ax2.set(xlim=z1mm, ylim=z3mm, xlabel=r"$z_1$", ylabel=r"$z_3$")
                 if idr == 0:
                     ax2.set_title(titlestring)
                 # y-z
-                ax3 = axs[idr, 2]
-                ax3.scatter(z2, z3, marker=".", c=color, alpha=alpha)
-                ax3.set_xlim(z2mm)
-                ax3.set_ylim(z3mm)
-                ax3.set_xlabel(r"$z_2$")
-                ax3.set_ylabel(r"$z_3$")
+                ax3 = axs[idr, col + 2]
+                _scatter(ax3, z2, z3, color, color_arr, scalar_map, alpha)
+                ax3.set(xlim=z2mm, ylim=z3mm, xlabel=r"$z_2$", ylabel=r"$z_3$")
                 # colorbar
-                divider = make_axes_locatable(axs[idr, 2])
+                divider = make_axes_locatable(ax3)
                 cax = divider.append_axes("right", size="5%", pad=0.1)
-                fig.colorbar(scalar_map, ax=axs[idr, 2], cax=cax)
+                fig.colorbar(scalar_map, ax=ax3, cax=cax)
 
                 if outlier_inds is not None:
                     # Plot outliers as diamonds with no transparency
@@ -176,23 +446,17 @@ def plot_tsne(
                     ax3.scatter(z2[outlier_inds], z3[outlier_inds], **outlier_kwargs)
 
             else:
-                ax = axs[idr]
+                ax = axs[idr, col]
                 z1, z2 = emb_trans[:, 0], emb_trans[:, 1]
-                ax.scatter(z1, z2, marker=".", c=color, alpha=alpha)
-                z1mm = np.min(z1), np.max(z1)
-                z2mm = np.min(z2), np.max(z2)
-                z1mm = (z1mm[0] * 0.95, z1mm[1] * 1.05)
-                z2mm = (z2mm[0] * 0.95, z2mm[1] * 1.05)
-                ax.set_xlim(z1mm)
-                ax.set_ylim(z2mm)
-                ax.set_xlabel(r"$z_1$")
-                ax.set_ylabel(r"$z_2$")
+                _scatter(ax, z1, z2, color, color_arr, scalar_map, alpha)
+                z1mm, z2mm = limits
+                ax.set(xlim=z1mm, ylim=z2mm, xlabel=r"$z_1$", ylabel=r"$z_2$")
                 if idr == 0:
                     ax.set_title(titlestring)
                 # colorbar
                 divider = make_axes_locatable(ax)
                 cax = divider.append_axes("right", size="5%", pad=0.1)
-                fig.colorbar(scalar_map, ax=axs, cax=cax)
+                fig.colorbar(scalar_map, ax=ax, cax=cax)
 
                 if outlier_inds is not None:
                     # Plot outliers as diamonds with no transparency
@@ -201,40 +465,85 @@ def plot_tsne(
 
             # plot as 3D object on wandb
             if (wandb_config is not None) and (perplexity == target_perplexity):
-                point_data = np.concatenate([emb_trans, color[:, :3] * 255.0], axis=1)
+                # x, y, z, r, g, b, 2d embeddings are drawn in the z=0 plane
+                point_data = np.zeros((len(emb_trans), 6), dtype=np.float32)
+                point_data[:, : emb_trans.shape[1]] = emb_trans
+                np.multiply(color[:, :3], 255.0, out=point_data[:, 3:])
                 caption = f"perplexity {perplexity} color {color_name}"
-                wandb.log(
-                    {
-                        f"3D t-SNE embeddings {color_name} paint": wandb.Object3D(
-                            point_data, caption=caption
-                        )
-                    },
-                    step=global_step,
+                wandb_futures.append(
+                    _WANDB_EXECUTOR.submit(
+                        _log_object3d,
+                        f"3D t-SNE embeddings {color_name} paint",
+                        point_data,
+                        caption,
+                        global_step,
+                    )
                 )
 
-        # tight layout
-        plt.tight_layout()
+    # tight layout
+    fig.tight_layout()
 
-        # save figure
-        time_stamp = time.strftime(
-            f"2d-embeddings-{color_name}-epoch-{epoch}-%Y%m%d-%H%M%S.png"
+    # save figure
+    color_names = "-".join(color_arrays)
+    time_stamp = time.strftime(
+        f"2d-embeddings-{color_names}-epoch-{epoch}-%Y%m%d-%H%M%S.png"
+    )
+    png = _save_figure(
+        fig, os.path.join(out_dir, time_stamp), dpi=dpi, compress_level=1
+    )
+
+    # wandb logging
+    if wandb_config is not None:
+        img = Image.open(png)
+        wandb.log(
+            {
+                f"2D t-SNE embeddings {color_names} paint": [
+                    wandb.Image(img, caption="Latent Space Visualizations")
+                ]
+            },
+            step=global_step,
         )
-        plt.savefig(os.path.join(out_dir, time_stamp), dpi=300)
 
-        # wandb logging
-        if wandb_config is not None:
-            img = Image.open(os.path.join(out_dir, time_stamp))
-            wandb.log(
-                {
-                    f"2D t-SNE embeddings {color_name} paint": [
-                        wandb.Image(img, caption="Latent Space Visualizations")
-                    ]
-                },
-                step=global_step,
-            )
+    # raise upload errors here
+    for future in wandb_futures:
+        future.result()
 
-        # close plot
-        plt.close(fig)
+
+def _project(
+    xyz: np.ndarray, elev: float = 30.0, azim: float = -60.0, size: int = 1000
+) -> np.ndarray:
+    r"""Orthographic projection of `xyz` onto the view plane of a 3d axes
+    at `elev`, `azim` (degrees, the mplot3d defaults), as flat pixel
+    indices into a size x size image."""
+    elev, azim = np.deg2rad(elev), np.deg2rad(azim)
+    view = np.array(
+        [
+            [-np.sin(azim), np.cos(azim), 0.0],
+            [
+                -np.sin(elev) * np.cos(azim),
+                -np.sin(elev) * np.sin(azim),
+                np.cos(elev),
+            ],
+        ]
+    )
+    uv = xyz @ view.T
+    uv -= uv.min(axis=0)
+    uv *= (size - 1) / np.maximum(uv.max(axis=0), np.finfo(uv.dtype).tiny)
+    uv = uv.astype(np.intp)
+    return uv[:, 1] * size + uv[:, 0]
+
+
+def _bin_colors(pixels: np.ndarray, rgba: np.ndarray, size: int = 1000) -> np.ndarray:
+    r"""Averages the colors of the points falling into each pixel, empty
+    pixels are transparent."""
+    counts = np.bincount(pixels, minlength=size * size)
+    image = np.zeros((size * size, 4))
+    for c in range(3):
+        image[:, c] = np.bincount(pixels, weights=rgba[:, c], minlength=size * size)
+    hit = counts > 0
+    image[hit, :3] /= counts[hit, None]
+    image[hit, 3] = 1.0
+    return image.reshape(size, size, 4)
 
 
 def plot_tsne_publication(
@@ -243,46 +552,65 @@ def plot_tsne_publication(
     colors=["rmsd"],
     pca=False,
     pca_dim=50,
+    cache_dir=None,
     wandb_config=None,
     global_step=0,
     epoch=1,
 ):
-    """Generate publication quality 3d t-SNE plot."""
-
-    color_arrays = parse_h5(embeddings_path, fields=colors + ["embeddings"])
+    """Generate publication quality 3d t-SNE plot. Above HEXBIN_THRESHOLD
+    points the 3d view is projected and binned into an image instead of
+    being drawn point by point by mplot3d. If cache_dir is given, the t-SNE
+    result is kept there, see compute_tsne."""
+
+    # all t-SNE backends work in single precision, read everything as float32
+    color_arrays = parse_h5(
+        embeddings_path, fields=colors + ["embeddings"], dtype=np.float32
+    )
     embeddings = color_arrays.pop("embeddings")
 
-    if pca and embeddings.shape[1] > 50:
-        embeddings = pca(embeddings, pca_dim)
+    if pca and embeddings.shape[1] > pca_dim:
+        embeddings = compute_pca(embeddings, pca_dim)
 
-    embeddings = compute_tsne(embeddings, n_components=3, n_jobs=4)
+    embeddings = compute_tsne(
+        embeddings,
+        n_components=3,
+        n_jobs=4,
+        cache_dir=cache_dir,
+    )
 
     z1, z2, z3 = embeddings[:, 0], embeddings[:, 1], embeddings[:, 2]
-    z1_min_max = np.min(z1), np.max(z1)
-    z2_min_max = np.min(z2), np.max(z2)
-    z3_min_max = np.min(z3), np.max(z3)
+    z1_min_max, z2_min_max, z3_min_max = zip(
+        embeddings.min(axis=0), embeddings.max(axis=0)
+    )
+    binned = len(embeddings) > HEXBIN_THRESHOLD
+    if binned:
+        pixels = _project(embeddings)
 
     # TODO: make grid plot of fnc, rmsd
     for color_name, color_arr in color_arrays.items():
 
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection="3d")
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111, projection=None if binned else "3d")
 
-        cnorm = matplotlib.colors.Normalize(
-            vmin=np.min(color_arr), vmax=np.max(color_arr)
-        )
-        scalar_map = matplotlib.cm.ScalarMappable(norm=cnorm, cmap=plt.get_cmap("jet"))
+        vmin, vmax = np.min(color_arr), np.max(color_arr)
+        cnorm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
+        scalar_map = matplotlib.cm.ScalarMappable(norm=cnorm, cmap=CMAP)
         scalar_map.set_array(color_arr)
-        fig.colorbar(scalar_map)
-        color = scalar_map.to_rgba(color_arr)
-
-        ax.scatter3D(z1, z2, z3, marker=".", c=color)
-        ax.set_xlim3d(z1_min_max)
-        ax.set_ylim3d(z2_min_max)
-        ax.set_zlim3d(z3_min_max)
-        ax.set_xlabel(r"$z_1$")
-        ax.set_ylabel(r"$z_2$")
-        ax.set_zlabel(r"$z_3$")
+        fig.colorbar(scalar_map, ax=ax)
+        color = _to_rgba(color_arr, vmin, vmax)
+
+        if binned:
+            ax.imshow(_bin_colors(pixels, color), origin="lower")
+            ax.set_axis_off()
+        else:
+            ax.scatter3D(z1, z2, z3, marker=".", c=color)
+            ax.set_xlim3d(z1_min_max)
+            ax.set_ylim3d(z2_min_max)
+            ax.set_zlim3d(z3_min_max)
+            ax.set_xlabel(r"$z_1$")
+            ax.set_ylabel(r"$z_2$")
+            ax.set_zlabel(r"$z_3$")
 
         if color_name == "rmsd":
             ax.set_title(f"RMSD to reference state after epoch {epoch}")
@@ -292,10 +620,10 @@ def plot_tsne_publication(
         time_stamp = time.strftime(
             f"3d-embeddings-{color_name}-epoch-{epoch}-%Y%m%d-%H%M%S.png"
         )
-        plt.savefig(os.path.join(out_dir, time_stamp), dpi=300)
+        png = _save_figure(fig, os.path.join(out_dir, time_stamp))
 
         if wandb_config is not None:
-            img = Image.open(os.path.join(out_dir, time_stamp))
+            img = Image.open(png)
             wandb.log(
                 {
                     f"3D xyz t-SNE embeddings {color_name} paint": [
@@ -305,9 +633,6 @@ def plot_tsne_publication(
                 step=global_step,
             )
 
-        ax.clear()
-        plt.close(fig)
-
 
 def plot_tsne_plotly(tsne_embeddings, df_dict={}, color=None):
 
@@ -1 +1,2 @@
 from .read_file import open_h5  # noqa
+from .cli import parse_dict  # noqa
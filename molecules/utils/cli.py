@@ -0,0 +1,21 @@
+import ast
+import json
+
+
+def parse_dict(ctx, param, value):
+    """
+    Click callback parsing a dict option, given either as a JSON object
+    or as a key=value list. Values keep their python types.
+    """
+    if value is not None:
+        if value.lstrip().startswith("{"):
+            return json.loads(value)
+        token = value.split(",")
+        result = {}
+        for item in token:
+            k, v = item.split("=")
+            try:
+                result[k] = ast.literal_eval(v)
+            except (ValueError, SyntaxError):
+                result[k] = v
+        return result
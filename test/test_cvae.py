@@ -4,7 +4,7 @@ import numpy as np
 import torch
 from torchsummary import summary
 from molecules.utils import open_h5
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, TensorDataset
 from molecules.ml.unsupervised.vae import SymmetricVAEHyperparams
 from molecules.ml.unsupervised.vae import VAE
 from molecules.ml.hyperparams import OptimizerHyperparams
@@ -360,6 +360,47 @@ class TestVAE:
 
         vae.train(train_loader, test_loader, self.epochs)
 
+    def test_accum_steps(self):
+        # 5 batches with accum_steps=2 leave a last window of 1 batch
+        batch_size, n_batches, accum_steps = 8, 5, 2
+        hparams = SymmetricVAEHyperparams(filters=[16, 16], kernels=[3, 3],
+                                          strides=[1, 2], affine_widths=[32],
+                                          affine_dropouts=[0], latent_dim=4)
+        optimizer_hparams = OptimizerHyperparams(name='SGD', hparams={'lr': 0.1})
+
+        vae = VAE(self.input_shape, hparams, optimizer_hparams,
+                  accum_steps=accum_steps, verbose=False)
+        baseline = VAE(self.input_shape, hparams, optimizer_hparams, verbose=False)
+        baseline.model.load_state_dict(vae.model.state_dict())
+
+        size = batch_size * n_batches
+        data = (torch.rand(size, *self.input_shape) > 0.5).to(torch.float32)
+        loader = DataLoader(TensorDataset(data, torch.zeros(size), torch.zeros(size),
+                                          torch.arange(size)),
+                            batch_size=batch_size)
+
+        torch.manual_seed(0)
+        vae._train(loader, 1, [], {})
+
+        # Gradients of full windows are averaged over accum_steps batches,
+        # the last window only over its own batch. Iterating the loader
+        # draws the same seeds as _train.
+        torch.manual_seed(0)
+        baseline.model.train()
+        baseline.optimizer.zero_grad()
+        for batch_idx, (batch, _, _, _) in enumerate(loader):
+            window = accum_steps if batch_idx < n_batches - 1 else 1
+            batch = batch.to(baseline.device.encoder)
+            logit_recon_batch, codes, mu, logvar = baseline.model(batch)
+            loss, _, _ = baseline._compute_loss(logit_recon_batch, batch, mu, logvar)
+            (loss / window).backward()
+            if (batch_idx + 1) % accum_steps == 0 or batch_idx == n_batches - 1:
+                baseline.optimizer.step()
+                baseline.optimizer.zero_grad()
+
+        for p, q in zip(vae.model.parameters(), baseline.model.parameters()):
+            assert torch.allclose(p, q, atol=1e-5)
+
     @classmethod
     def teardown_class(self):
         # Delete file to clean testing directories
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import pytest
+import h5py
+import numpy as np
+import torch
+from molecules.utils import open_h5
+from torch.utils.data import TensorDataset
+from molecules.ml.datasets import ContactMapDataset, materialize_dataset, unpack_bits
+
+class TestDatasets:
+
+    @classmethod
+    def setup_class(self):
+        self.num_residues = 22
+        self.shape = (1, self.num_residues, self.num_residues)
+
+        with open_h5('./test/cvae_input.h5') as input_file:
+            maps = np.array(input_file['contact_maps'][:100])
+        self.maps = maps.reshape(-1, self.num_residues, self.num_residues).astype(bool)
+        self.values = np.random.rand(*self.maps.shape).astype(np.float32) * self.maps
+        self.rmsd = np.linspace(0., 1., len(self.maps), dtype=np.float32)
+        self.fnc = np.linspace(1., 0., len(self.maps), dtype=np.float32)
+
+        # Small chunks, so that a batch spans several of them
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'contact_maps.h5')
+        vlen = h5py.vlen_dtype(np.int16)
+        with open_h5(self.path, 'w') as f:
+            f.create_dataset('full', data=self.maps.astype(np.float32), chunks=(16, 22, 22))
+            f.create_dataset('packed', data=np.packbits(self.maps, axis=-1), chunks=(16, 22, 3))
+
+            concat = f.create_dataset('sparse-concat', (len(self.maps),), dtype=vlen, chunks=(16,))
+            weighted = f.create_dataset('weighted', (len(self.maps),), dtype=vlen, chunks=(16,))
+            weighted_values = f.create_dataset('weighted_values', (len(self.maps),),
+                                               dtype=h5py.vlen_dtype(np.float32), chunks=(16,))
+            group = f.create_group('sparse-rowcol')
+            row = group.create_dataset('row', (len(self.maps),), dtype=vlen, chunks=(16,))
+            col = group.create_dataset('col', (len(self.maps),), dtype=vlen, chunks=(16,))
+            for i, cm in enumerate(self.maps):
+                r, c = np.nonzero(cm)
+                concat[i] = np.concatenate([r, c]).astype(np.int16)
+                weighted[i] = np.concatenate([r, c]).astype(np.int16)
+                weighted_values[i] = self.values[i, r, c]
+                row[i] = r.astype(np.int16)
+                col[i] = c.astype(np.int16)
+
+            f.create_dataset('rmsd', data=self.rmsd, chunks=(16,))
+            f.create_dataset('fnc', data=self.fnc, chunks=(16,))
+
+    @classmethod
+    def teardown_class(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _dataset(self, dataset_name, cm_format, split='train'):
+        return ContactMapDataset(self.path, dataset_name, 'rmsd', 'fnc', self.shape,
+                                 split=split, cm_format=cm_format)
+
+    def test_getitems_matches_getitem(self):
+        for name, cm_format in [('full', 'full'),
+                                ('packed', 'packed'),
+                                ('sparse-concat', 'sparse-concat'),
+                                ('sparse-rowcol', 'sparse-rowcol'),
+                                ('weighted', 'sparse-concat')]:
+            dataset = self._dataset(name, cm_format)
+            # unsorted, repeated and spanning several chunks
+            idxs = [7, 0, 41, 7, 16, 15, len(dataset) - 1]
+
+            batch = dataset.__getitems__(idxs)
+            for idx, token in zip(idxs, batch):
+                single = dataset[idx]
+                assert torch.equal(token[0], single[0])
+                assert token[0].dtype == dataset.dtype
+                assert token[1] == single[1]
+                assert token[2] == single[2]
+                assert token[3] == single[3]
+
+    def test_getitems_reads_file(self):
+        for name, cm_format, expected in [('full', 'full', self.maps),
+                                          ('sparse-concat', 'sparse-concat', self.maps),
+                                          ('sparse-rowcol', 'sparse-rowcol', self.maps),
+                                          ('weighted', 'sparse-concat', self.values)]:
+            dataset = self._dataset(name, cm_format, split='valid')
+            for data, rmsd, fnc, index in dataset.__getitems__(range(len(dataset))):
+                assert np.array_equal(data.numpy(), expected[index])
+                assert rmsd.item() == pytest.approx(self.rmsd[index])
+                assert fnc.item() == pytest.approx(self.fnc[index])
+
+    def test_binary_maps_are_bool(self):
+        assert self._dataset('sparse-concat', 'sparse-concat').dtype == torch.bool
+        assert self._dataset('sparse-rowcol', 'sparse-rowcol').dtype == torch.bool
+        assert self._dataset('weighted', 'sparse-concat').dtype == torch.float32
+        assert self._dataset('full', 'full').dtype == torch.float32
+
+    def test_unpack_bits(self):
+        packed = torch.from_numpy(np.packbits(self.maps, axis=-1))
+        unpacked = unpack_bits(packed, self.num_residues)
+
+        assert unpacked.dtype == torch.bool
+        assert unpacked.shape == self.maps.shape
+        assert np.array_equal(unpacked.numpy(), self.maps)
+
+        # Widths which are not a multiple of 8
+        bits = np.random.rand(5, 13, 13) > 0.5
+        packed = torch.from_numpy(np.packbits(bits, axis=-1))
+        assert np.array_equal(unpack_bits(packed, 13).numpy(), bits)
+
+    def test_packed_dataset(self):
+        dataset = self._dataset('packed', 'packed')
+        assert dataset.dtype == torch.uint8
+
+        for data, _, _, index in dataset.__getitems__([3, 40, 17]):
+            assert data.shape == (self.num_residues, 3)
+            assert np.array_equal(unpack_bits(data, self.num_residues).numpy(),
+                                  self.maps[index])
+
+    def test_materialize_dataset(self):
+        for name, cm_format in [('sparse-concat', 'sparse-concat'),
+                                ('weighted', 'sparse-concat'),
+                                ('packed', 'packed')]:
+            dataset = self._dataset(name, cm_format)
+            # several blocks, the last one partial
+            materialized = materialize_dataset(dataset, block_size=16)
+
+            assert isinstance(materialized, TensorDataset)
+            assert len(materialized) == len(dataset)
+            for idx in [0, 15, 16, len(dataset) - 1]:
+                expected = dataset[idx]
+                token = materialized[idx]
+                assert token[0].dtype == dataset.dtype
+                assert torch.equal(token[0], expected[0])
+                assert token[1].item() == pytest.approx(expected[1].item())
+                assert token[2].item() == pytest.approx(expected[2].item())
+                assert token[3].item() == expected[3]
+
+        # too large datasets are returned as they are
+        dataset = self._dataset('full', 'full')
+        assert materialize_dataset(dataset, max_bytes=1) is dataset
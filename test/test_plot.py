@@ -0,0 +1,18 @@
+import pytest
+import numpy as np
+from molecules.plot.tsne import compute_pca
+
+class TestPlot:
+
+    def test_compute_pca(self):
+        embeddings = np.random.normal(size=(200, 64)).astype(np.float32)
+        embeddings[:, 0] *= 100.
+
+        pca = compute_pca(embeddings, dim=10)
+
+        assert pca.shape == (200, 10)
+        assert pca.dtype == np.float32
+        assert np.allclose(pca.mean(axis=0), 0., atol=1e-3)
+        # The dominant direction comes first
+        assert np.var(pca[:, 0]) > np.var(pca[:, 1:], axis=0).max()
+        assert abs(np.corrcoef(pca[:, 0], embeddings[:, 0])[0, 1]) > 0.99